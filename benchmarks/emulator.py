@@ -0,0 +1,367 @@
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from collections import deque
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import datetime, timezone
+from multiprocessing.connection import Connection
+from multiprocessing.connection import wait
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Annotated, Any
+
+import boto3
+import typer
+from click import Choice
+from typer import Option
+
+from benchmarks.generator import generate_project
+from benchmarks.generator import shapes
+from benchmarks.run import git_commit
+from benchmarks.run import repo_path
+
+cli = typer.Typer(
+    add_completion=False,
+    pretty_exceptions_enable=False,
+)
+
+
+def container_main(conn: Connection, tmp_dir: str, env: dict[str, str]):
+    """
+    The process of an emulated Lambda container. It handles one event at a time until it receives None.
+
+    The handler is imported on the first event, so the first invocation includes the cold start.
+    """
+    os.environ.update(env)
+    os.environ['TMPDIR'] = tmp_dir
+    tempfile.tempdir = None
+    handler = None
+    while (event := conn.recv()) is not None:
+        init_duration = None
+        if handler is None:
+            start = time.perf_counter()
+            import dbt_lambda.app
+            # dbt_lambda configures the root logger on import
+            logging.getLogger().setLevel(logging.WARNING)
+            handler = dbt_lambda.app.lambda_handler
+            init_duration = time.perf_counter() - start
+        start = time.perf_counter()
+        try:
+            response = handler(event, None)
+            error = response.get('error') if isinstance(response, dict) else None
+            cached = isinstance(response, dict) and response.get('cached', False)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            cached = False
+        conn.send({
+            'init_duration': init_duration,
+            'duration': time.perf_counter() - start,
+            'error': error,
+            'cached': cached,
+        })
+
+
+@dataclass
+class Container:
+    index: int
+    process: Any
+    conn: Connection
+    tmp_path: Path
+    invocations: int = 0
+    idle_since: float = 0
+    request: dict | None = None
+
+
+@dataclass
+class Emulator:
+    """
+    Routes events to emulated Lambda containers like the Lambda service does.
+
+    An event goes to the most recently used idle container. If no container is idle, a new container
+    is started until max_containers is reached, otherwise the event waits in the queue. Containers are
+    recycled after max_reuse invocations and reclaimed after idle_timeout seconds without an event.
+    Each container is a process with its own temporary directory as /tmp.
+    """
+    root: Path
+    env: dict[str, str]
+    max_containers: int = 4
+    max_reuse: int = 0
+    idle_timeout: float = 600
+    containers: list[Container] = field(default_factory=list)
+    started: int = 0
+    records: list[dict] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.context = multiprocessing.get_context('spawn')
+
+    def start_container(self) -> Container:
+        tmp_path = self.root / f'container-{self.started}'
+        tmp_path.mkdir(parents=True)
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=container_main, args=(child_conn, str(tmp_path), self.env), daemon=True)
+        process.start()
+        container = Container(index=self.started, process=process, conn=conn, tmp_path=tmp_path)
+        self.started += 1
+        self.containers.append(container)
+        return container
+
+    def stop_container(self, container: Container):
+        container.conn.send(None)
+        container.process.join()
+        self.containers.remove(container)
+
+    def idle_containers(self) -> list[Container]:
+        return [container for container in self.containers if container.request is None]
+
+    def dispatch(self, request: dict) -> bool:
+        """
+        Send the request to a container.
+
+        Returns:
+            False if all containers are busy and no container can be started.
+        """
+        now = time.perf_counter()
+        for container in self.idle_containers():
+            if now - container.idle_since > self.idle_timeout:
+                self.stop_container(container)
+        idle = sorted(self.idle_containers(), key=lambda container: container.idle_since)
+        if idle:
+            container = idle[-1]
+        elif len(self.containers) < self.max_containers:
+            container = self.start_container()
+        else:
+            return False
+        event = request['event']
+        if 'base_path' not in event:
+            # the default base path is shared by all processes on this machine
+            event = {**event, 'base_path': str(container.tmp_path / 'dbt-project')}
+        request['container'] = container.index
+        request['dispatched_at'] = now
+        container.request = request
+        container.conn.send(event)
+        return True
+
+    def collect(self, timeout: float | None = None):
+        """
+        Wait for busy containers to finish their requests.
+        """
+        busy = {container.conn: container for container in self.containers if container.request is not None}
+        if not busy:
+            return
+        for conn in wait(list(busy), timeout=timeout):
+            container = busy[conn]  # type: ignore
+            result = conn.recv()  # type: ignore
+            now = time.perf_counter()
+            request = container.request
+            assert request is not None
+            self.records.append({
+                **result,
+                'container': container.index,
+                'cold': result['init_duration'] is not None,
+                'queue_wait': request['dispatched_at'] - request['arrived_at'],
+                'latency': now - request['arrived_at'],
+            })
+            container.request = None
+            container.idle_since = now
+            container.invocations += 1
+            if self.max_reuse and container.invocations >= self.max_reuse:
+                self.stop_container(container)
+
+    def replay(self, trace: list[dict]) -> float:
+        """
+        Replay the events of the trace at their offsets in seconds.
+
+        Returns:
+            The wall time of the replay.
+        """
+        start = time.perf_counter()
+        pending: deque[dict] = deque()
+        for item in sorted(trace, key=lambda item: item.get('at', 0)):
+            while (delay := start + item.get('at', 0) - time.perf_counter()) > 0:
+                if any(container.request is not None for container in self.containers):
+                    self.collect(timeout=delay)
+                else:
+                    time.sleep(delay)
+                while pending and self.dispatch(pending[0]):
+                    pending.popleft()
+            pending.append({'event': item['event'], 'arrived_at': time.perf_counter()})
+            while pending and self.dispatch(pending[0]):
+                pending.popleft()
+        while pending or any(container.request is not None for container in self.containers):
+            self.collect()
+            while pending and self.dispatch(pending[0]):
+                pending.popleft()
+        return time.perf_counter() - start
+
+    def shutdown(self):
+        for container in list(self.containers):
+            self.stop_container(container)
+
+
+def percentiles(values: list[float]) -> dict[str, float] | None:
+    if not values:
+        return None
+    if len(values) == 1:
+        quantiles = values * 99
+    else:
+        quantiles = statistics.quantiles(values, n=100, method='inclusive')
+    return {
+        'p50': quantiles[49],
+        'p90': quantiles[89],
+        'p99': quantiles[98],
+        'max': max(values),
+    }
+
+
+def summarize(records: list[dict], wall_time: float, containers_started: int) -> dict:
+    cold = [record for record in records if record['cold']]
+    return {
+        'requests': len(records),
+        'errors': sum(1 for record in records if record['error'] is not None),
+        'containers': containers_started,
+        'cold_starts': len(cold),
+        'cold_start_share': len(cold) / len(records) if records else 0,
+        'cached': sum(1 for record in records if record['cached']),
+        'throughput': len(records) / wall_time if wall_time > 0 else 0,
+        'wall_time': wall_time,
+        'latency': percentiles([record['latency'] for record in records]),
+        'duration': percentiles([record['duration'] for record in records]),
+        'warm_duration': percentiles([record['duration'] for record in records if not record['cold']]),
+        'init_duration': percentiles([record['init_duration'] for record in cold]),
+        'queue_wait': percentiles([record['queue_wait'] for record in records]),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def synthetic_trace(requests: int, rate: float, args: list[str]) -> list[dict]:
+    return [{'at': i / rate, 'event': {'args': args, 'source': 's3'}} for i in range(requests)]
+
+
+def emulate(
+        trace: list[dict],
+        max_containers: int = 4,
+        max_reuse: int = 0,
+        idle_timeout: float = 600,
+        n_models: int = 20,
+        shape: str = 'wide',
+) -> dict:
+    """
+    Replay the trace on emulated containers, offline with a moto server and dbt-duckdb.
+
+    The containers read the project archive of a synthetic project from the docs bucket of the moto server.
+    """
+    from moto.server import ThreadedMotoServer
+
+    port = free_port()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    env = {
+        'AWS_ENDPOINT_URL': f'http://127.0.0.1:{port}',
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_SESSION_TOKEN': 'testing',
+        'AWS_DEFAULT_REGION': 'eu-central-1',
+        'SAM_CONFIG_FILE': os.environ.get(
+            'SAM_CONFIG_FILE', str(repo_path / 'example' / 'transform' / 'samconfig.yaml')
+        ),
+        'PYTHONPATH': os.pathsep.join([str(repo_path / 'src'), str(repo_path), os.environ.get('PYTHONPATH', '')]),
+    }
+    saved_env = dict(os.environ)
+    os.environ.update(env)
+    emulator = None
+    try:
+        from dbt_lambda import git
+        from dbt_lambda.config import set_env_vars
+
+        logging.getLogger().setLevel(logging.WARNING)
+        set_env_vars()
+        boto3.client('s3').create_bucket(
+            Bucket=os.environ['DBT_DOCS_BUCKET'],
+            CreateBucketConfiguration={'LocationConstraint': 'eu-central-1'}
+        )
+        boto3.client('secretsmanager').create_secret(Name=os.environ['SNOWFLAKE_SECRET_ARN'], SecretString='{}')
+        with TemporaryDirectory() as tmp_dir:
+            source_path = generate_project(Path(tmp_dir) / 'source', n_models=n_models, shape=shape)
+            git.copy_to_s3(source_path)
+
+            emulator = Emulator(
+                root=Path(tmp_dir) / 'containers',
+                env=env,
+                max_containers=max_containers,
+                max_reuse=max_reuse,
+                idle_timeout=idle_timeout,
+            )
+            wall_time = emulator.replay(trace)
+            summary = summarize(emulator.records, wall_time, emulator.started)
+    finally:
+        if emulator is not None:
+            emulator.shutdown()
+        os.environ.clear()
+        os.environ.update(saved_env)
+        server.stop()
+    return {'summary': summary, 'records': emulator.records}
+
+
+@cli.command()
+def cli_emulate(
+        trace: Annotated[Path | None, Option(help="JSON lines with the offset 'at' in seconds and the 'event'")] = None,
+        requests: Annotated[int, Option(help="number of requests of the synthetic trace")] = 20,
+        rate: Annotated[float, Option(help="requests per second of the synthetic trace")] = 2,
+        args: Annotated[str, Option(help="dbt arguments of the synthetic trace")] = 'run',
+        containers: Annotated[int, Option(help="maximum number of concurrent containers")] = 4,
+        max_reuse: Annotated[int, Option(help="recycle containers after this many invocations, 0 never")] = 0,
+        idle_timeout: Annotated[float, Option(help="seconds after which idle containers are reclaimed")] = 600,
+        models: Annotated[int, Option(help="number of models in the synthetic project")] = 20,
+        shape: Annotated[str, Option(help="DAG shape of the synthetic project", click_type=Choice(shapes))] = 'wide',
+        output: Annotated[Path | None, Option(help="write the summary and records as JSON to this file")] = None,
+):
+    if trace is not None:
+        events = [json.loads(line) for line in trace.read_text().splitlines() if line.strip()]
+    else:
+        events = synthetic_trace(requests, rate, args.split())
+    result = emulate(
+        events,
+        max_containers=containers,
+        max_reuse=max_reuse,
+        idle_timeout=idle_timeout,
+        n_models=models,
+        shape=shape,
+    )
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'params': {
+            'containers': containers, 'max_reuse': max_reuse, 'idle_timeout': idle_timeout,
+            'models': models, 'shape': shape, 'requests': len(events),
+        },
+        **result,
+    }
+    summary = result['summary']
+    print(
+        f'{summary["requests"]} requests, {summary["errors"]} errors, {summary["throughput"]:0.2f} req/s, '
+        f'{summary["cold_start_share"]:0.0%} cold starts, latency p50 {summary["latency"]["p50"]:0.2f}s '
+        f'p99 {summary["latency"]["p99"]:0.2f}s',
+        file=sys.stderr
+    )
+    body = json.dumps(report, indent=2)
+    if output is None:
+        print(body)
+    else:
+        output.write_text(body)
+
+
+if __name__ == '__main__':
+    cli()
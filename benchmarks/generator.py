@@ -0,0 +1,106 @@
+import io
+import shutil
+import zipfile
+from pathlib import Path
+
+shapes = ('wide', 'deep', 'diamond')
+
+
+def model_dependencies(n_models: int, shape: str = 'wide') -> list[list[int]]:
+    """
+    Build the upstream dependencies for each model of a synthetic dbt project.
+
+    Args:
+        n_models: Number of models.
+        shape: DAG shape. 'wide' has one root model with all other models depending on it,
+            'deep' is a single chain and 'diamond' repeats a root, two parallel branches and a join.
+
+    Returns:
+        A list with the indices of the upstream models for each model.
+    """
+    if shape not in shapes:
+        raise ValueError(f'Unknown shape "{shape}". Choose from {", ".join(shapes)}.')
+    dependencies: list[list[int]] = []
+    for i in range(n_models):
+        if i == 0:
+            dependencies.append([])
+        elif shape == 'wide':
+            dependencies.append([0])
+        elif shape == 'deep':
+            dependencies.append([i - 1])
+        else:
+            # 0 -> (1, 2) -> 3 -> (4, 5) -> 6 ...
+            match i % 3:
+                case 1 | 2:
+                    dependencies.append([i - i % 3])
+                case _:
+                    dependencies.append([i - 2, i - 1])
+    return dependencies
+
+
+def generate_project(
+        base_path: Path,
+        n_models: int = 10,
+        shape: str = 'wide',
+        name: str = 'bench',
+) -> Path:
+    """
+    Write a synthetic dbt-duckdb project with n models and a test per model.
+
+    Args:
+        base_path: Directory of the project. Existing content is removed.
+        n_models: Number of models.
+        shape: DAG shape, see model_dependencies.
+        name: Name of the dbt project and profile.
+
+    Returns:
+        The base path of the project.
+    """
+    dependencies = model_dependencies(n_models, shape)
+    shutil.rmtree(base_path, ignore_errors=True)
+    (base_path / 'models').mkdir(parents=True)
+    (base_path / 'profiles').mkdir()
+    (base_path / 'dbt_project.yml').write_text(
+        f'version: 1.0.0\n'
+        f'config-version: 2\n'
+        f'name: {name}\n'
+        f'\n'
+        f'profile: {name}\n'
+    )
+    (base_path / 'profiles' / 'profiles.yml').write_text(
+        f'{name}:\n'
+        f'  outputs:\n'
+        f'    dev:\n'
+        f'      type: duckdb\n'
+        f'  target: dev\n'
+    )
+    schema = ['version: 2', '', 'models:']
+    for i, upstream in enumerate(dependencies):
+        if upstream:
+            sql = '\nUNION ALL\n'.join(
+                f"SELECT id + 1 AS id, 'model_{i}' AS label FROM {{{{ ref('model_{j}') }}}}" for j in upstream
+            )
+        else:
+            sql = "SELECT range AS id, 'model_0' AS label FROM range(100)"
+        (base_path / 'models' / f'model_{i}.sql').write_text(sql + '\n')
+        schema.extend([
+            f'  - name: model_{i}',
+            '    columns:',
+            '      - name: id',
+            '        tests:',
+            '          - not_null',
+        ])
+    (base_path / 'models' / 'schema.yml').write_text('\n'.join(schema) + '\n')
+    return base_path
+
+
+def zip_project(base_path: Path, prefix: str = 'tatenmitdaten-bench-0000000') -> bytes:
+    """
+    Zip the project the way the GitHub zipball endpoint does, with a single top-level folder.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for file_path in sorted(base_path.glob('**/*')):
+            if file_path.is_file():
+                zipf.write(file_path, Path(prefix) / file_path.relative_to(base_path))
+    return buffer.getvalue()
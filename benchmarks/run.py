@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Annotated, Callable
+from unittest import mock
+
+import boto3
+import typer
+from click import Choice
+from moto import mock_aws
+from typer import Option
+
+from benchmarks.generator import generate_project
+from benchmarks.generator import shapes
+from benchmarks.generator import zip_project
+
+repo_path = Path(__file__).parent.parent
+
+cli = typer.Typer(
+    add_completion=False,
+    pretty_exceptions_enable=False,
+)
+
+
+class FakeZipballResponse:
+    """
+    Local stand-in for the response of the GitHub zipball endpoint.
+    """
+    status_code = 200
+    text = ''
+
+    def __init__(self, content: bytes):
+        self.content = content
+
+
+def measure(name: str, func: Callable, repeat: int, setup: Callable | None = None) -> dict:
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    result = {
+        'name': name,
+        'repeat': repeat,
+        'min': min(durations),
+        'median': statistics.median(durations),
+        'mean': statistics.mean(durations),
+        'max': max(durations),
+    }
+    print(f'{name.ljust(30, ".")}{result["median"]:0.4f}s (min {result["min"]:0.4f}s)', file=sys.stderr)
+    return result
+
+
+def cold_import() -> None:
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([str(repo_path / 'src'), os.environ.get('PYTHONPATH', '')])}
+    subprocess.run([sys.executable, '-c', 'import dbt_lambda.app'], env=env, check=True)
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=repo_path, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(n_models: int, shape: str, repeat: int) -> list[dict]:
+    """
+    Time each step of the invocation path against a synthetic project, offline with moto and dbt-duckdb.
+    """
+    results = [measure('cold_import', cold_import, repeat)]
+
+    from dbt_lambda import git
+    from dbt_lambda.config import set_env_vars
+    from dbt_lambda.docs import save_index_html
+    from dbt_lambda.main import run_single_threaded
+
+    # dbt_lambda configures the root logger on import
+    logging.getLogger().setLevel(logging.WARNING)
+
+    os.environ.setdefault('SAM_CONFIG_FILE', str(repo_path / 'example' / 'transform' / 'samconfig.yaml'))
+    for key in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+        os.environ[key] = 'testing'
+    os.environ['AWS_DEFAULT_REGION'] = 'eu-central-1'
+
+    with mock_aws(), TemporaryDirectory() as tmp_dir:
+        results.append(measure('set_env_vars', set_env_vars, repeat))
+
+        s3 = boto3.client('s3')
+        s3.create_bucket(
+            Bucket=os.environ['DBT_DOCS_BUCKET'],
+            CreateBucketConfiguration={'LocationConstraint': 'eu-central-1'}
+        )
+        boto3.client('secretsmanager').create_secret(Name=os.environ['SNOWFLAKE_SECRET_ARN'], SecretString='{}')
+        os.environ['GITHUB_ACCESS_TOKEN'] = 'testing'
+
+        source_path = generate_project(Path(tmp_dir) / 'source', n_models=n_models, shape=shape)
+        zipball = FakeZipballResponse(zip_project(source_path))
+        base_path = Path(tmp_dir) / 'dbt-project'
+
+        with mock.patch.object(git.requests, 'get', return_value=zipball):
+            results.append(measure(
+                'copy_from_repo',
+                lambda: git.copy_from_repo(base_path, repository_name='bench', ref='master', upload_to_s3=False),
+                repeat
+            ))
+        results.append(measure('copy_to_s3', lambda: git.copy_to_s3(base_path), repeat))
+
+        s3_path = Path(tmp_dir) / 's3' / 'dbt-project'
+
+        def clear_s3_path() -> None:
+            # without the tree and its marker every repetition downloads and extracts the whole archive
+            shutil.rmtree(s3_path, ignore_errors=True)
+            git.archive_marker_path(s3_path).unlink(missing_ok=True)
+            s3_path.mkdir(parents=True)
+
+        results.append(measure('copy_from_s3_cold', lambda: git.copy_from_s3(s3_path), repeat, setup=clear_s3_path))
+        # the archive is unchanged, so a warm container only compares the ETag
+        results.append(measure('copy_from_s3_warm', lambda: git.copy_from_s3(s3_path), repeat))
+
+        results.append(measure(
+            'parse',
+            lambda: run_single_threaded(['parse'], source='local', base_path=base_path),
+            repeat
+        ))
+        results.append(measure(
+            'run_single_threaded',
+            lambda: run_single_threaded(['build'], source='local', base_path=base_path),
+            repeat
+        ))
+        run_single_threaded(['docs', 'generate'], source='local', base_path=base_path)
+        results.append(measure('save_index_html', lambda: save_index_html(base_path), repeat))
+
+    return results
+
+
+def compare(results: list[dict], baseline: dict, threshold: float) -> list[str]:
+    previous = {result['name']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        if result['name'] not in previous:
+            continue
+        before = previous[result['name']]['median']
+        after = result['median']
+        if before > 0 and (after - before) / before > threshold:
+            regressions.append(f'{result["name"]}: {before:0.4f}s -> {after:0.4f}s (+{(after / before - 1):0.0%})')
+    return regressions
+
+
+@cli.command()
+def cli_benchmark(
+        models: Annotated[int, Option(help="number of models in the synthetic project")] = 20,
+        shape: Annotated[str, Option(help="DAG shape of the synthetic project", click_type=Choice(shapes))] = 'wide',
+        repeat: Annotated[int, Option(help="number of repetitions per benchmark")] = 3,
+        output: Annotated[Path | None, Option(help="write results as JSON to this file")] = None,
+        baseline: Annotated[Path | None, Option(help="JSON results of a previous commit to compare against")] = None,
+        threshold: Annotated[float, Option(help="relative slowdown of the median reported as regression")] = 0.2,
+):
+    results = run_benchmarks(n_models=models, shape=shape, repeat=repeat)
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'params': {'models': models, 'shape': shape, 'repeat': repeat},
+        'results': results,
+    }
+    body = json.dumps(report, indent=2)
+    if output is None:
+        print(body)
+    else:
+        output.write_text(body)
+
+    if baseline is not None:
+        regressions = compare(results, json.loads(baseline.read_text()), threshold)
+        for regression in regressions:
+            print(f'Regression {regression}', file=sys.stderr)
+        if regressions:
+            raise typer.Exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -2,4 +2,8 @@ import dbt_lambda.app
 
 
 def lambda_handler(event, context):
-    return dbt_lambda.app.lambda_handler(event, context)
\ No newline at end of file
+    return dbt_lambda.app.lambda_handler(event, context)
+
+
+def sqs_handler(event, context):
+    return dbt_lambda.app.sqs_handler(event, context)
@@ -1,15 +1,47 @@
+import json
+import logging
 import os
+from pathlib import Path
 from typing import Any
 
+from dbt_lambda.artifacts import answer_from_cache
+from dbt_lambda.artifacts import cached_commands
+from dbt_lambda.artifacts import get_artifacts_key
+from dbt_lambda.artifacts import publish_artifacts
+from dbt_lambda.cache import use_project
+from dbt_lambda.coalesce import group_requests
+from dbt_lambda.coalesce import is_coalescable
+from dbt_lambda.coalesce import Request
+from dbt_lambda.coalesce import RequestGroup
 from dbt_lambda.config import set_env_vars
 from dbt_lambda.git import copy_from_repo
 from dbt_lambda.git import default_base_path
+from dbt_lambda.history import compact_history
+from dbt_lambda.history import get_history_prefix
+from dbt_lambda.main import Command
+from dbt_lambda.main import CommandResult
+from dbt_lambda.main import invoke_command
+from dbt_lambda.main import prepare_project
+from dbt_lambda.main import run_commands
 from dbt_lambda.main import run_single_threaded
 from dbt_lambda.main import RunnerResult
+from dbt_lambda.main import select_nodes
+from dbt_lambda.profiling import top_nodes
+from dbt_lambda.timing import emit_metrics
+from dbt_lambda.timing import max_rss
+from dbt_lambda.timing import record
+from dbt_lambda.timing import span
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
 
 payload = dict[str, Any]
 
 
+# node statuses that fail a request of a coalesced run, nodes are skipped if an upstream node failed
+failure_statuses = ('error', 'fail', 'skipped', 'timeout')
+
+
 class DbtTestError(Exception):
     pass
 
@@ -22,7 +54,76 @@ def notify_hook(response: payload) -> str | None:
 
 
 def lambda_handler(event, _) -> payload:
-    set_env_vars()
+    with record(trace_memory=os.environ.get('DBT_TRACE_MEMORY', 'False') == 'True') as timings:
+        with span('config'):
+            set_env_vars()
+        response = handle_event(event)
+    if 'nodes' in response:
+        response['timings'] = timings.as_list
+        response['max_rss'] = max_rss()
+        emit_metrics(timings)
+    return response
+
+
+def project_location(event) -> tuple[str | None, str | None, Path | str]:
+    """
+    The repository, ref and base path of the project of the event.
+    """
+    # projects of other repositories are kept side by side in the project cache
+    repository_name = event.get('repository')
+    ref = None
+    base_path = event.get('base_path', default_base_path)
+    if repository_name is not None:
+        ref = event.get('ref') or os.environ.get('DBT_REPOSITORY_BRANCH', 'master')
+        if 'base_path' not in event:
+            base_path = use_project(repository_name, ref)
+    return repository_name, ref, base_path
+
+
+def handle_commands(event) -> payload:
+    """
+    Run the commands of the event in order on one copy of the project.
+    """
+    commands = [
+        Command(
+            args=command['args'],
+            continue_on_error=command.get('continue_on_error', False),
+            state=command.get('state', event.get('state')),
+        )
+        for command in event['commands']
+    ]
+    if len(commands) == 0:
+        return {
+            'statusCode': 200,
+            'message': 'No commands provided. Nothing to do.'
+        }
+    repository_name, ref, base_path = project_location(event)
+    with span('run'):
+        results = run_commands(
+            commands=commands,
+            source=event.get('source', 'repo'),
+            base_path=base_path,
+            repository_name=repository_name,
+            ref=ref,
+        )
+
+    # commands that failed with continue_on_error still fail the batch, they only don't stop it
+    success = len(results) == len(commands) and all(result.success for result in results)
+    steps = [step_response(command, result) for command, result in zip(commands, results)]
+    response = {
+        'message': '\n'.join(result.result.as_str for result in results if result.result is not None),
+        'success': success,
+        'steps': steps,
+        'nodes': [node for step in steps for node in step['nodes']],
+    }
+    if not success:
+        response['error'] = 'DbtRuntimeError'
+    return response
+
+
+def handle_event(event) -> payload:
+    if 'commands' in event:
+        return handle_commands(event)
     args = event.get('args', [])
     if len(args) == 0:
         return {
@@ -44,6 +145,14 @@ def lambda_handler(event, _) -> payload:
             os.environ['FAIL_ON_ERROR'] = 'True'
             os.environ['DBT_REPOSITORY_BRANCH'] = 'test'
             args = ['build']
+        case 'x-compact-history':
+            repository_name = event.get('repository')
+            ref = event.get('ref') or os.environ.get('DBT_REPOSITORY_BRANCH', 'master')
+            return {
+                **compact_history(get_history_prefix(repository_name, ref if repository_name else None)),
+                'success': True,
+                'nodes': [],
+            }
         case 'x-skip':
             return {
                 'message': 'Skip dbt execution',
@@ -51,18 +160,162 @@ def lambda_handler(event, _) -> payload:
                 'nodes': []
             }
 
-    res: RunnerResult = run_single_threaded(
-        args=args,
-        source=event.get('source', 'repo'),
-        base_path=event.get('base_path', default_base_path)
-    )
+    # answer read-only commands from the artifacts of the project version without credentials
+    artifacts_key = None
+    if args[0] in cached_commands and event.get('cache', True):
+        with span('cache'):
+            artifacts_key = get_artifacts_key(event)
+            cached = answer_from_cache(args, artifacts_key) if artifacts_key is not None else None
+        if cached is not None:
+            logger.info(f'Answered {" ".join(args)} from the artifacts of {artifacts_key}')
+            return {**result_response(cached), 'cached': True}
+
+    repository_name, ref, base_path = project_location(event)
+    with span('run'):
+        res: RunnerResult = run_single_threaded(
+            args=args,
+            source=event.get('source', 'repo'),
+            base_path=base_path,
+            state=event.get('state'),
+            repository_name=repository_name,
+            ref=ref,
+        )
+
+    if artifacts_key is not None and res.success:
+        with span('publish_artifacts'):
+            # the ref or the project archive can move between the resolution of the key and the copy
+            if get_artifacts_key(event) == artifacts_key:
+                publish_artifacts(Path(base_path).absolute(), artifacts_key, compiled=args[0] == 'compile')
+            else:
+                logger.warning(f'The project version changed during the run. Skip publishing the artifacts of {artifacts_key}')
+
+    return result_response(res, skipped='state' in event)
 
+
+def result_response(res: RunnerResult, skipped: bool = False) -> payload:
     response = {
         'message': res.as_str,
         'success': res.success,
         'nodes': [node.as_dict for node in res.nodes]
     }
+    if skipped:
+        response['skipped'] = res.skipped
+    if res.stragglers:
+        response['stragglers'] = res.stragglers
+    if res.regressions:
+        response['regressions'] = res.regressions
+    if res.output:
+        response['output'] = res.output
+    if res.compiled:
+        response['compiled'] = res.compiled
+    if res.run_id is not None:
+        response['run_id'] = res.run_id
+    if res.nodes:
+        response['top_nodes'] = top_nodes(res.nodes)
     if not res.success:
         response['error'] = 'DbtRuntimeError'
+    return response
+
 
+def step_response(command: Command, result: CommandResult) -> payload:
+    """
+    The response of one command of a batch, with its args, wall time and the error of a failed command.
+    """
+    response: payload = {'args': result.args, 'wall_time': result.wall_time}
+    if result.result is not None:
+        response.update(result_response(result.result, skipped=command.state is not None))
+    else:
+        response.update({'success': False, 'nodes': []})
+    if result.error is not None:
+        response['error'] = result.error
     return response
+
+
+def sqs_handler(event, _) -> payload:
+    """
+    Handle a batch of SQS messages with one event per message body.
+
+    Requests that only differ in their selection are coalesced into one dbt run with the union of
+    their selections. The results are fanned out to the requests by their own selection.
+    Failed requests are reported as batch item failures, so only they are retried.
+    """
+    with record(trace_memory=os.environ.get('DBT_TRACE_MEMORY', 'False') == 'True') as timings:
+        with span('config'):
+            set_env_vars()
+        requests = []
+        responses = {}
+        for sqs_record in event.get('Records', []):
+            message_id = sqs_record['messageId']
+            try:
+                requests.append(Request(message_id=message_id, event=json.loads(sqs_record['body'])))
+            except (KeyError, ValueError) as e:
+                logger.error(f'Invalid message {message_id}: {e}')
+                responses[message_id] = {'error': type(e).__name__, 'message': str(e)}
+        responses.update(handle_requests(requests))
+    emit_metrics(timings)
+    return {
+        'batchItemFailures': [
+            {'itemIdentifier': message_id} for message_id, response in responses.items() if 'error' in response
+        ],
+        'responses': responses,
+    }
+
+
+def handle_requests(requests: list[Request]) -> dict[str, payload]:
+    """
+    Handle the requests of a batch and return the responses by message id.
+    """
+    responses = {}
+    for request in requests:
+        if not is_coalescable(request.event):
+            responses[request.message_id] = handle_request(request)
+    for i, group in enumerate(group_requests([request for request in requests if is_coalescable(request.event)])):
+        with span(f'group-{i}'):
+            try:
+                responses.update(run_group(group))
+            except Exception as e:
+                logger.exception(f'Failed to run {" ".join(group.coalesced_args)}')
+                for request in group.requests:
+                    responses[request.message_id] = {'error': type(e).__name__, 'message': str(e), 'success': False}
+    return responses
+
+
+def handle_request(request: Request) -> payload:
+    try:
+        return handle_event(request.event)
+    except Exception as e:
+        logger.exception(f'Failed to handle message {request.message_id}')
+        return {'error': type(e).__name__, 'message': str(e), 'success': False}
+
+
+def run_group(group: RequestGroup) -> dict[str, payload]:
+    """
+    Run the coalesced command of the group once and fan out the results to its requests.
+    """
+    event = group.coalesced_event
+    repository_name, ref, base_path = project_location(event)
+    with span('run'):
+        project = prepare_project(event.get('source', 'repo'), base_path, repository_name, ref)
+        res = invoke_command(project, group.coalesced_args, event.get('state'))
+    if len(group.requests) == 1:
+        return {group.requests[0].message_id: result_response(res, skipped='state' in event)}
+
+    # the nodes skipped by the state selection have no result but did not fail
+    executed = {node.node_info['unique_id'] for node in res.nodes} | set(res.skipped)
+    responses = {}
+    with span('fan_out'):
+        for request in group.requests:
+            selected = set(select_nodes(project, request.args))
+            nodes = [node for node in res.nodes if node.node_info['unique_id'] in selected]
+            # a failed command may not have reached the selected nodes, e.g. on a compilation error
+            request_success = not (selected - executed) and all(node.status not in failure_statuses for node in nodes)
+            request_result = RunnerResult(
+                success=res.success or request_success,
+                nodes=nodes,
+                skipped=[unique_id for unique_id in res.skipped if unique_id in selected],
+                stragglers=[straggler for straggler in res.stragglers if straggler['unique_id'] in selected],
+                run_id=res.run_id,
+                regressions=[regression for regression in res.regressions if regression['unique_id'] in selected],
+            )
+            responses[request.message_id] = result_response(request_result, skipped='state' in event)
+    return responses
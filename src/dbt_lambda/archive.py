@@ -0,0 +1,367 @@
+import bz2
+import logging
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+from typing import Protocol
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+compression_methods = {
+    'stored': zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+}
+# zip headers, see section 4.3 of the zip file format specification
+file_header = struct.Struct('<4s2B4HL2L2H')
+file_header_magic = b'PK\003\004'
+central_dir_header = struct.Struct('<4s4B4HL2L5H2L')
+central_dir_magic = b'PK\001\002'
+end_record_header = struct.Struct('<4s4H2LH')
+end_record_magic = b'PK\005\006'
+min_part_size = 5 * 1024 * 1024
+default_part_size = 8 * 1024 * 1024
+
+
+class Writer(Protocol):
+    def write(self, data: bytes) -> None:
+        ...
+
+
+@dataclass
+class ArchiveEntry:
+    name: str
+    zip_info: zipfile.ZipInfo
+    data: bytes
+    offset: int = 0
+
+
+def compress_file(path: Path, name: str, method: str = 'deflated', level: int = 6) -> ArchiveEntry:
+    """
+    Read and compress a single file for a zip archive.
+
+    Args:
+        path: The file to compress.
+        name: The name of the file in the archive.
+        method: The compression method, one of 'stored', 'deflated' or 'bzip2'.
+        level: The compression level.
+    """
+    zip_info = zipfile.ZipInfo.from_file(path, name)
+    raw = path.read_bytes()
+    match method:
+        case 'stored':
+            data = raw
+        case 'deflated':
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            data = compressor.compress(raw) + compressor.flush()
+        case 'bzip2':
+            data = bz2.compress(raw, max(1, min(level, 9)))
+        case _:
+            raise ValueError(f'Unknown compression method "{method}". Choose from {", ".join(compression_methods)}.')
+    zip_info.compress_type = compression_methods[method]
+    zip_info.CRC = zlib.crc32(raw)
+    zip_info.file_size = len(raw)
+    zip_info.compress_size = len(data)
+    return ArchiveEntry(name=name, zip_info=zip_info, data=data)
+
+
+def dos_date_time(zip_info: zipfile.ZipInfo) -> tuple[int, int]:
+    year, month, day, hour, minute, second = zip_info.date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+def write_archive(
+        files: Iterable[tuple[Path, str]],
+        writer: Writer,
+        method: str = 'deflated',
+        level: int = 6,
+        max_workers: int = 8,
+) -> int:
+    """
+    Write a zip archive to a sequential writer while the files are compressed in parallel.
+
+    The files are compressed by a thread pool with a bounded number of files in flight and
+    written to the writer in order. The archive doesn't need a seekable output because sizes and
+    checksums are known before each entry is written. Zip64 is not supported.
+
+    Args:
+        files: The paths of the files and their names in the archive.
+        writer: The output, e.g. a MultipartWriter.
+        method: The compression method, one of 'stored', 'deflated' or 'bzip2'.
+        level: The compression level.
+        max_workers: Number of compression threads.
+
+    Returns:
+        The size of the archive in bytes.
+    """
+    if method not in compression_methods:
+        raise ValueError(f'Unknown compression method "{method}". Choose from {", ".join(compression_methods)}.')
+    offset = 0
+    entries = []
+
+    def write_entry(entry: ArchiveEntry):
+        nonlocal offset
+        zip_info = entry.zip_info
+        encoded_name = entry.name.encode('utf-8')
+        flag_bits = 0x800 if not entry.name.isascii() else 0
+        dos_time, dos_date = dos_date_time(zip_info)
+        extract_version = 46 if zip_info.compress_type == zipfile.ZIP_BZIP2 else 20
+        header = file_header.pack(
+            file_header_magic, extract_version, 0, flag_bits,
+            zip_info.compress_type, dos_time, dos_date, zip_info.CRC, zip_info.compress_size,
+            zip_info.file_size, len(encoded_name), 0
+        )
+        if offset + len(header) + len(encoded_name) + len(entry.data) >= 0xFFFFFFFF:
+            raise ValueError('Archive exceeds 4 GiB. Zip64 is not supported.')
+        entry.offset = offset
+        writer.write(header + encoded_name)
+        writer.write(entry.data)
+        offset += len(header) + len(encoded_name) + len(entry.data)
+        # the data is not needed for the central directory
+        entry.data = b''
+        entries.append(entry)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight: deque[Future] = deque()
+        for path, name in files:
+            in_flight.append(executor.submit(compress_file, path, name, method, level))
+            if len(in_flight) >= 2 * max_workers:
+                write_entry(in_flight.popleft().result())
+        while in_flight:
+            write_entry(in_flight.popleft().result())
+
+    if len(entries) >= 0xFFFF:
+        raise ValueError('Archive has too many entries. Zip64 is not supported.')
+    central_directory = bytearray()
+    for entry in entries:
+        zip_info = entry.zip_info
+        encoded_name = entry.name.encode('utf-8')
+        flag_bits = 0x800 if not entry.name.isascii() else 0
+        dos_time, dos_date = dos_date_time(zip_info)
+        extract_version = 46 if zip_info.compress_type == zipfile.ZIP_BZIP2 else 20
+        central_directory += central_dir_header.pack(
+            central_dir_magic, extract_version, 3, extract_version, 0,
+            flag_bits, zip_info.compress_type, dos_time, dos_date, zip_info.CRC, zip_info.compress_size,
+            zip_info.file_size, len(encoded_name), 0, 0, 0, 0, zip_info.external_attr, entry.offset
+        ) + encoded_name
+    end_record = end_record_header.pack(
+        end_record_magic, 0, 0, len(entries), len(entries),
+        len(central_directory), offset, 0
+    )
+    writer.write(bytes(central_directory) + end_record)
+    return offset + len(central_directory) + len(end_record)
+
+
+class MultipartWriter:
+    """
+    Writable stream that uploads to S3 in parts while it is written.
+
+    Memory is bounded by the part size times the number of parts in flight. Objects smaller
+    than one part are uploaded with a single put_object call.
+    """
+
+    def __init__(self, client, bucket: str, key: str, part_size: int = default_part_size, max_concurrency: int = 4):
+        if part_size < min_part_size:
+            raise ValueError(f'Part size must be at least {min_part_size} bytes')
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id: str | None = None
+        self.parts: list[Future] = []
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+
+    def write(self, data: bytes):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self.upload_part(part)
+
+    def upload_part(self, body: bytes):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self.parts) + 1
+
+        def upload() -> dict:
+            try:
+                response = self.client.upload_part(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body
+                )
+                return {'ETag': response['ETag'], 'PartNumber': part_number}
+            finally:
+                self.slots.release()
+
+        # block until a slot is free to bound the memory of parts in flight
+        self.slots.acquire()
+        self.parts.append(self.executor.submit(upload))
+
+    def close(self):
+        try:
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            else:
+                try:
+                    if self.buffer:
+                        self.upload_part(bytes(self.buffer))
+                    parts = [part.result() for part in self.parts]
+                    self.client.complete_multipart_upload(
+                        Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': parts}
+                    )
+                except Exception:
+                    # a failed part or completion leaves an incomplete upload that is billed until aborted
+                    self.abort()
+                    raise
+            self.buffer = bytearray()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def abort(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            logger.info(f'Aborted multipart upload to s3://{self.bucket}/{self.key}')
+
+    def __enter__(self) -> 'MultipartWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def download_file(
+        client,
+        bucket: str,
+        key: str,
+        path: Path,
+        size: int,
+        etag: str | None = None,
+        part_size: int = default_part_size,
+        max_workers: int = 8,
+):
+    """
+    Download an S3 object to a file with parallel ranged GET requests.
+
+    Args:
+        client: The S3 client.
+        bucket: The bucket name.
+        key: The object key.
+        path: The target file.
+        size: The size of the object.
+        etag: Only download the object if it still has this ETag.
+        part_size: The size of each range.
+        max_workers: Number of parallel requests.
+    """
+    condition = {'IfMatch': etag} if etag else {}
+    with path.open('wb') as f:
+        f.truncate(size)
+        fd = f.fileno()
+
+        def download_range(start: int):
+            end = min(start + part_size, size) - 1
+            response = client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}', **condition)
+            os.pwrite(fd, response['Body'].read(), start)
+
+        if size <= part_size:
+            response = client.get_object(Bucket=bucket, Key=key, **condition)
+            f.write(response['Body'].read())
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # consume the results to raise errors of the requests
+                list(executor.map(download_range, range(0, size, part_size)))
+
+
+def file_crc32(path: Path) -> int:
+    crc = 0
+    with path.open('rb') as f:
+        while chunk := f.read(1024 * 1024):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def extract_changed(
+        zip_path: Path,
+        target_path: Path,
+        previous_names: Iterable[str] = (),
+        strip_components: int = 1,
+        max_workers: int = 8,
+) -> dict:
+    """
+    Extract only the entries of an archive that differ from the existing files.
+
+    Entries are compared with the existing files by size and CRC and the changed entries are
+    written in parallel. Files of the previous extraction that are no longer in the archive are removed.
+
+    Args:
+        zip_path: The archive.
+        target_path: The directory to extract to.
+        previous_names: The names of the files of the previous extraction relative to the target path.
+        strip_components: Number of leading path components to strip from the names in the archive.
+        max_workers: Number of threads that write files.
+
+    Returns:
+        The extracted names and the number of written, unchanged and removed files.
+    """
+    target_path = target_path.absolute()
+    target_path.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(zip_path) as zipf:
+        entries = {}
+        for info in zipf.infolist():
+            if info.is_dir():
+                continue
+            name = '/'.join(info.filename.split('/')[strip_components:])
+            path = (target_path / name).resolve()
+            if not name or not path.is_relative_to(target_path.resolve()):
+                raise ValueError(f'Invalid path "{info.filename}" in archive {zip_path}')
+            entries[name] = (info, path)
+
+        def is_unchanged(info: zipfile.ZipInfo, path: Path) -> bool:
+            return path.is_file() and path.stat().st_size == info.file_size and file_crc32(path) == info.CRC
+
+        def extract(item: tuple[zipfile.ZipInfo, Path]) -> bool:
+            info, path = item
+            if is_unchanged(info, path):
+                return False
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f'.{path.name}.tmp')
+            with zipf.open(info) as source, tmp_path.open('wb') as target:
+                while chunk := source.read(1024 * 1024):
+                    target.write(chunk)
+            os.replace(tmp_path, path)
+            return True
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            written = sum(executor.map(extract, entries.values()))
+
+    removed = 0
+    for name in set(previous_names) - set(entries):
+        path = target_path / name
+        if path.is_file():
+            path.unlink()
+            removed += 1
+            # remove directories that became empty
+            for parent in path.parents:
+                if parent == target_path or any(parent.iterdir()):
+                    break
+                parent.rmdir()
+
+    return {
+        'names': sorted(entries),
+        'written': written,
+        'unchanged': len(entries) - written,
+        'removed': removed,
+    }
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import boto3
+from botocore.exceptions import ClientError
+
+from dbt_lambda.docs import get_dbt_docs_bucket
+from dbt_lambda.git import project_archive_key
+from dbt_lambda.git import resolve_commit
+from dbt_lambda.secrets import set_github_token_to_env
+from dbt_lambda.state import filter_args
+from dbt_lambda.state import project_options
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+artifacts_prefix = 'artifacts'
+# read-only commands that can be answered from a cached manifest
+cached_commands = ('ls', 'list', 'parse', 'compile')
+# options that need the project, the state or the warehouse and are not answered from the cache
+uncached_options = ('--selector', '--state', '--defer', '--inline', '--favor-state', '--empty')
+
+# manifests and their graphs loaded in a warm container by artifacts key and name
+loaded_manifests: dict[tuple[str, str], object] = {}
+loaded_graphs: dict[int, object] = {}
+
+
+def get_artifacts_root() -> Path:
+    """
+    The directory of the cached artifacts, /tmp/dbt-artifacts on AWS Lambda.
+    """
+    return Path(os.environ.get('DBT_ARTIFACTS_ROOT', Path(tempfile.gettempdir()) / 'dbt-artifacts'))
+
+
+def manifest_name(compiled: bool) -> str:
+    return 'compiled-manifest.json' if compiled else 'manifest.json'
+
+
+def get_artifacts_key(event: dict) -> str | None:
+    """
+    The key of the cached artifacts of the project version of the event.
+
+    The version is the 'sha' of the event, the commit of the ref in the repository or the ETag of the
+    project archive in the docs bucket. Project options like --target and --vars change the manifest
+    and are part of the key.
+
+    Returns:
+        The key or None if the project version is unknown.
+    """
+    args = event.get('args', [])
+    source = event.get('source', 'repo')
+    repository_name = event.get('repository')
+    ref = event.get('ref') or os.environ.get('DBT_REPOSITORY_BRANCH', 'master')
+    version = event.get('sha')
+    if version is None and source == 'repo':
+        set_github_token_to_env()
+        version = resolve_commit(repository_name or os.environ['DBT_REPOSITORY_NAME'], ref)
+    elif version is None and source == 's3':
+        key = project_archive_key(repository_name, ref if repository_name else None)
+        try:
+            head = boto3.client('s3').head_object(Bucket=os.environ['DBT_DOCS_BUCKET'], Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        version = 'etag-' + head['ETag'].strip('"')
+    if version is None:
+        return None
+    options = [arg for arg in filter_args(args, project_options) if arg not in ('--project-dir', '--profiles-dir')]
+    if options:
+        return f'{version}-{hashlib.sha256(json.dumps(options).encode("utf-8")).hexdigest()[:12]}'
+    return version
+
+
+def publish_artifacts(base_path: Path, key: str, compiled: bool = False):
+    """
+    Cache the manifest in the target directory of the project in /tmp and in the docs bucket.
+
+    Args:
+        base_path: The base path of the dbt project.
+        key: The artifacts key of the project version.
+        compiled: The manifest was written by a compile and has the compiled code of the nodes.
+    """
+    name = manifest_name(compiled)
+    path = get_artifacts_root() / key / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(base_path / 'target' / 'manifest.json', path)
+    bucket = get_dbt_docs_bucket()
+    bucket.upload_file(str(path), f'{artifacts_prefix}/{key}/{name}')
+    manifest = loaded_manifests.pop((key, name), None)
+    loaded_graphs.pop(id(manifest), None)
+    logger.info(f'Published {name} to s3://{bucket.name}/{artifacts_prefix}/{key}/{name}')
+
+
+def load_manifest(key: str, compiled: bool = False):
+    """
+    Load a cached manifest from memory, /tmp or the docs bucket.
+
+    Returns:
+        The manifest or None if it is not cached.
+    """
+    from dbt.contracts.graph.manifest import Manifest
+    from dbt.contracts.graph.manifest import WritableManifest
+
+    name = manifest_name(compiled)
+    if (key, name) in loaded_manifests:
+        return loaded_manifests[(key, name)]
+    path = get_artifacts_root() / key / name
+    if not path.exists():
+        bucket = get_dbt_docs_bucket()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            bucket.download_file(f'{artifacts_prefix}/{key}/{name}', str(path))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+    manifest = Manifest.from_writable_manifest(WritableManifest.read_and_check_versions(str(path)))
+    loaded_manifests[(key, name)] = manifest
+    return manifest
+
+
+def parse_flags(args: list[str]):
+    """
+    Parse the dbt arguments like dbt does and set them as the global flags used by the node selection.
+    """
+    from dbt.cli.flags import Flags
+    from dbt.cli.main import cli
+    from dbt.flags import set_flags
+
+    # the directories are only validated, the project itself is not read
+    root = get_artifacts_root()
+    root.mkdir(parents=True, exist_ok=True)
+    ctx = cli.make_context(cli.name, args[:1])
+    command = cli.get_command(ctx, args[0])
+    if command is None:
+        raise ValueError(f'Unknown dbt command "{args[0]}"')
+    command_args = [*args[1:], '--project-dir', str(root), '--profiles-dir', str(root)]
+    flags = Flags(command.make_context(args[0], command_args, parent=ctx))
+    set_flags(flags)
+    return flags
+
+
+def get_graph(manifest):
+    from dbt.compilation import Linker
+    from dbt.graph import Graph
+
+    if id(manifest) not in loaded_graphs:
+        linker = Linker()
+        linker.link_graph(manifest)
+        loaded_graphs[id(manifest)] = Graph(linker.graph)
+    return loaded_graphs[id(manifest)]
+
+
+def select_nodes(manifest, flags, resource_types) -> list[str]:
+    from dbt.graph import parse_difference
+    from dbt.graph import ResourceTypeSelector
+
+    selector = ResourceTypeSelector(
+        graph=get_graph(manifest),
+        manifest=manifest,
+        previous_state=None,
+        resource_types=resource_types,
+        include_empty_nodes=True,
+    )
+    select = list(getattr(flags, 'MODELS', None) or flags.SELECT or ()) or None
+    exclude = list(flags.EXCLUDE or ()) or None
+    return sorted(selector.get_selected(parse_difference(select, exclude)))
+
+
+def list_output(manifest, unique_ids: list[str], flags) -> list[str]:
+    """
+    The output of dbt ls for the selected nodes.
+    """
+    from dbt.node_types import NodeType
+    from dbt.task.list import ListTask
+    from dbt.utils import JSONEncoder
+
+    collections = (
+        manifest.nodes, manifest.sources, manifest.exposures, manifest.metrics,
+        manifest.semantic_models, manifest.unit_tests, manifest.saved_queries,
+    )
+    output = []
+    for unique_id in unique_ids:
+        node = next(collection[unique_id] for collection in collections if unique_id in collection)
+        match flags.OUTPUT:
+            case 'name':
+                output.append(node.search_name)
+            case 'path':
+                output.append(node.original_file_path)
+            case 'json':
+                keys = flags.OUTPUT_KEYS or ListTask.ALLOWED_KEYS
+                output.append(json.dumps(
+                    {k: v for k, v in node.to_dict(omit_none=False).items() if k in keys}, cls=JSONEncoder
+                ))
+            case _:
+                if node.resource_type == NodeType.Source:
+                    output.append(f'source:{node.package_name}.{node.source_name}.{node.name}')
+                elif node.resource_type == NodeType.Unit:
+                    output.append(f'unit_test:{node.package_name}.{node.versioned_name}')
+                elif node.resource_type in (
+                        NodeType.Exposure, NodeType.Metric, NodeType.SavedQuery, NodeType.SemanticModel
+                ):
+                    output.append(f'{node.resource_type}:{node.package_name}.{node.name}')
+                else:
+                    output.append('.'.join(node.fqn))
+    return output
+
+
+def answer_from_cache(args: list[str], key: str):
+    """
+    Answer a read-only command from the cached manifest without the project and without warehouse credentials.
+
+    Args:
+        args: The dbt arguments of an ls, parse or compile command.
+        key: The artifacts key of the project version.
+
+    Returns:
+        A RunnerResult or None if the command can't be answered from the cache.
+    """
+    from dbt.node_types import EXECUTABLE_NODE_TYPES
+    from dbt.node_types import NodeType
+    from dbt.task.base import resource_types_from_args
+    from dbt.task.list import ListTask
+
+    from dbt_lambda.main import NodeResult
+    from dbt_lambda.main import RunnerResult
+
+    if args[0] not in cached_commands or any(arg in uncached_options for arg in args):
+        return None
+    compiled = args[0] == 'compile'
+    manifest = load_manifest(key, compiled=compiled)
+    if manifest is None and not compiled:
+        manifest = load_manifest(key, compiled=True)
+    if manifest is None:
+        logger.info(f'No cached manifest for {key}')
+        return None
+
+    flags = parse_flags(args)
+    if args[0] == 'parse':
+        return RunnerResult(success=True, nodes=[])
+    if args[0] in ('ls', 'list'):
+        if getattr(flags, 'MODELS', None):
+            resource_types = [NodeType.Model]
+        else:
+            resource_types = list(resource_types_from_args(
+                flags, set(ListTask.ALL_RESOURCE_VALUES), set(ListTask.DEFAULT_RESOURCE_VALUES)
+            ))
+        unique_ids = select_nodes(manifest, flags, resource_types)
+        return RunnerResult(success=True, nodes=[], output=list_output(manifest, unique_ids, flags))
+
+    nodes = [manifest.nodes[unique_id] for unique_id in select_nodes(manifest, flags, EXECUTABLE_NODE_TYPES)]
+    if any(node.compiled_code is None for node in nodes):
+        logger.info(f'Cached manifest of {key} has nodes that are not compiled')
+        return None
+    return RunnerResult(
+        success=True,
+        nodes=[
+            NodeResult(node_info=node.node_info, status='success', execution_time=0, failures=None)
+            for node in nodes
+        ],
+        compiled={node.unique_id: node.compiled_code for node in nodes},
+    )
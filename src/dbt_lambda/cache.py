@@ -0,0 +1,76 @@
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+
+def get_cache_root() -> Path:
+    """
+    The directory of the project cache, /tmp/dbt-projects on AWS Lambda.
+    """
+    return Path(os.environ.get('DBT_CACHE_ROOT', Path(tempfile.gettempdir()) / 'dbt-projects'))
+
+
+def project_key(repository_name: str, ref: str) -> str:
+    return re.sub(r'[^A-Za-z0-9._-]', '-', f'{repository_name}@{ref}')
+
+
+def project_path(repository_name: str, ref: str, root: Path | None = None) -> Path:
+    """
+    The base path of the cached project tree of a repository at a ref.
+    """
+    return (root or get_cache_root()) / project_key(repository_name, ref) / 'dbt-project'
+
+
+def evict_projects(keep: Path | None = None, min_free_bytes: int | None = None, root: Path | None = None) -> list[str]:
+    """
+    Remove the least recently used cached projects until enough space is available.
+
+    Args:
+        keep: The cache entry that is used by the current invocation and is never evicted.
+        min_free_bytes: The space that should be free on the cache file system.
+            Defaults to DBT_CACHE_MIN_FREE_MB or 256 MB.
+        root: The cache root.
+
+    Returns:
+        The evicted cache entries.
+    """
+    root = root or get_cache_root()
+    if not root.exists():
+        return []
+    if min_free_bytes is None:
+        min_free_bytes = int(os.environ.get('DBT_CACHE_MIN_FREE_MB', 256)) * 1024 * 1024
+    entries = sorted(
+        (entry for entry in root.iterdir() if entry.is_dir() and entry != keep),
+        key=lambda entry: entry.stat().st_mtime
+    )
+    evicted = []
+    for entry in entries:
+        if shutil.disk_usage(root).free >= min_free_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        evicted.append(entry.name)
+        logger.info(f'Evicted cached project {entry.name}')
+    return evicted
+
+
+def use_project(repository_name: str, ref: str, root: Path | None = None) -> Path:
+    """
+    Mark the cached project as recently used and make space for it.
+
+    Returns:
+        The base path of the cached project.
+    """
+    base_path = project_path(repository_name, ref, root)
+    entry = base_path.parent
+    entry.mkdir(parents=True, exist_ok=True)
+    now = time.time()
+    os.utime(entry, (now, now))
+    evict_projects(keep=entry, root=root)
+    return base_path
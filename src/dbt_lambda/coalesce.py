@@ -0,0 +1,104 @@
+import json
+import logging
+from dataclasses import dataclass
+from dataclasses import field
+
+from dbt_lambda.state import selection_commands
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+# options whose values are combined into a union selection
+select_options = ('--select', '-s', '--models', '-m')
+# event keys that must be equal for requests to share a run
+group_keys = ('source', 'state', 'repository', 'ref', 'base_path')
+
+
+@dataclass
+class Request:
+    message_id: str
+    event: dict
+
+    @property
+    def args(self) -> list[str]:
+        return self.event.get('args', [])
+
+
+@dataclass
+class RequestGroup:
+    args: list[str]
+    event: dict
+    requests: list[Request] = field(default_factory=list)
+    # the union of the selections, None selects all nodes
+    selection: list[str] | None = field(default_factory=list)
+
+    @property
+    def coalesced_args(self) -> list[str]:
+        if self.selection is None:
+            return self.args
+        return [*self.args, '--select', *self.selection]
+
+    @property
+    def coalesced_event(self) -> dict:
+        return {**self.event, 'args': self.coalesced_args}
+
+
+def split_selection(args: list[str]) -> tuple[list[str], list[str] | None]:
+    """
+    Split the dbt arguments into the selection and the other arguments.
+
+    Returns:
+        The arguments without the select options and the selected values or None if nothing is selected.
+    """
+    rest = []
+    selection = None
+    in_selection = False
+    for arg in args:
+        if arg.startswith('-'):
+            in_selection = arg in select_options
+            if in_selection:
+                selection = selection if selection is not None else []
+                continue
+        if in_selection:
+            selection.append(arg)
+        else:
+            rest.append(arg)
+    return rest, selection
+
+
+def is_coalescable(event: dict) -> bool:
+    """
+    Only the execution commands of events without commands lists are coalesced. The responses of other
+    commands, e.g. the output of ls or the compiled code of compile, are not fanned out by selection
+    and commands that can be answered from cached artifacts are not delayed by a run.
+    """
+    args = event.get('args', [])
+    return 'commands' not in event and len(args) > 0 and args[0] in selection_commands
+
+
+def group_requests(requests: list[Request]) -> list[RequestGroup]:
+    """
+    Group the requests that only differ in their selection and union their selections.
+
+    Identical requests end up in the same group without adding to the selection.
+
+    Returns:
+        The groups in the order of their first request.
+    """
+    groups: dict[str, RequestGroup] = {}
+    for request in requests:
+        rest, selection = split_selection(request.args)
+        event = {key: request.event[key] for key in group_keys if key in request.event}
+        key = json.dumps([rest, event], sort_keys=True, default=str)
+        if key not in groups:
+            groups[key] = RequestGroup(args=rest, event=event)
+        group = groups[key]
+        group.requests.append(request)
+        if selection is None or group.selection is None:
+            group.selection = None
+        else:
+            group.selection.extend(value for value in selection if value not in group.selection)
+    for group in groups.values():
+        if len(group.requests) > 1:
+            logger.info(f'Coalesced {len(group.requests)} requests into {" ".join(group.coalesced_args)}')
+    return list(groups.values())
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+
+@dataclass
+class PooledHandle:
+    handle: Any
+    released_at: float
+
+
+def credentials_key(credentials) -> str:
+    """
+    Hash the adapter credentials. Handles are only reused for identical credentials.
+    """
+    data = json.dumps(credentials.to_dict(), sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ConnectionPool:
+    """
+    Pool of open warehouse connection handles that outlives a single dbt invocation.
+
+    dbt closes every connection when a node is released and when an invocation ends. In a warm
+    Lambda container we hook into the open and close class methods of the adapter connection manager
+    and park the open handles in this pool instead. The next connection with the same credentials
+    takes a parked handle and skips the connection setup and authentication handshake.
+    Handles that were idle longer than idle_timeout are closed, handles that were idle longer than
+    health_check_after are checked with a trivial query before they are reused.
+    """
+
+    def __init__(self, idle_timeout: float = 300, health_check_after: float = 30, max_size: int = 16):
+        self.enabled = False
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.handles: dict[str, list[PooledHandle]] = {}
+        self.installed: set[type] = set()
+        self.local = threading.local()
+        self.stats = {'opened': 0, 'reused': 0, 'closed': 0}
+
+    def configure(self, enabled: bool, idle_timeout: float | None = None):
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        if enabled and not self.enabled:
+            self.install_factory_hook()
+        if not enabled and self.enabled:
+            self.close_all()
+        self.enabled = enabled
+        if enabled:
+            self.evict_idle()
+
+    def take(self, key: str) -> Any | None:
+        while True:
+            with self.lock:
+                handles = self.handles.get(key)
+                if not handles:
+                    return None
+                pooled = handles.pop()
+            idle = time.monotonic() - pooled.released_at
+            if idle > self.idle_timeout:
+                logger.info(f'Closing connection handle idle for {idle:0.0f}s')
+                self.close_handle(pooled.handle)
+                continue
+            if idle > self.health_check_after and not self.is_healthy(pooled.handle):
+                logger.info('Closing unhealthy connection handle')
+                self.close_handle(pooled.handle)
+                continue
+            self.stats['reused'] += 1
+            return pooled.handle
+
+    def put(self, key: str, handle: Any) -> bool:
+        with self.lock:
+            handles = self.handles.setdefault(key, [])
+            if len(handles) >= self.max_size:
+                return False
+            handles.append(PooledHandle(handle=handle, released_at=time.monotonic()))
+            return True
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            expired: list[PooledHandle] = []
+            for key, handles in self.handles.items():
+                expired.extend(pooled for pooled in handles if now - pooled.released_at > self.idle_timeout)
+                self.handles[key] = [pooled for pooled in handles if now - pooled.released_at <= self.idle_timeout]
+        for pooled in expired:
+            self.close_handle(pooled.handle)
+        if expired:
+            logger.info(f'Closed {len(expired)} idle connection handles')
+
+    def close_all(self):
+        with self.lock:
+            handles = [pooled for pooled_handles in self.handles.values() for pooled in pooled_handles]
+            self.handles.clear()
+        for pooled in handles:
+            self.close_handle(pooled.handle)
+
+    def size(self) -> int:
+        with self.lock:
+            return sum(len(handles) for handles in self.handles.values())
+
+    def close_handle(self, handle: Any):
+        self.stats['closed'] += 1
+        try:
+            handle.close()
+        except Exception as e:
+            logger.warning(f'Failed to close connection handle: {e}')
+
+    @staticmethod
+    def is_healthy(handle: Any) -> bool:
+        try:
+            if getattr(handle, 'is_closed', lambda: False)():
+                return False
+            cursor = handle.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def install(self, manager_class: Any):
+        """
+        Route open and close of the connection manager class through the pool.
+        """
+        if manager_class in self.installed:
+            return
+        from dbt.adapters.contracts.connection import ConnectionState
+
+        pool = self
+        open_connection = manager_class.open
+        close_connection = manager_class.close
+        close_handle = manager_class._close_handle
+
+        def pooled_open(cls, connection):
+            if pool.enabled and connection.state != ConnectionState.OPEN:
+                handle = pool.take(credentials_key(connection.credentials))
+                if handle is not None:
+                    connection.handle = handle
+                    connection.state = ConnectionState.OPEN
+                    return connection
+                pool.stats['opened'] += 1
+            return open_connection(connection)
+
+        def pooled_close(cls, connection):
+            # a handle with an open transaction is closed, the rollback might not reach the handle
+            pool.local.discard = connection.transaction_open
+            try:
+                return close_connection(connection)
+            finally:
+                pool.local.discard = False
+
+        def pooled_close_handle(cls, connection):
+            if pool.enabled and connection.handle is not None and not getattr(pool.local, 'discard', False):
+                if pool.put(credentials_key(connection.credentials), connection.handle):
+                    connection.handle = None
+                    return
+            close_handle(connection)
+
+        manager_class.open = classmethod(pooled_open)  # type: ignore
+        manager_class.close = classmethod(pooled_close)  # type: ignore
+        manager_class._close_handle = classmethod(pooled_close_handle)  # type: ignore
+        self.installed.add(manager_class)
+        logger.info(f'Installed connection pool for {manager_class.__name__}')
+
+    def install_factory_hook(self):
+        """
+        Install the pool for every adapter registered by a dbt invocation.
+        """
+        from dbt.adapters.factory import FACTORY
+
+        if getattr(FACTORY.register_adapter, 'pooled', False):
+            return
+        register_adapter = FACTORY.register_adapter
+
+        def pooled_register_adapter(config, *args, **kwargs):
+            register_adapter(config, *args, **kwargs)
+            adapter = FACTORY.lookup_adapter(config.credentials.type)
+            self.install(type(adapter.connections))
+
+        pooled_register_adapter.pooled = True  # type: ignore
+        FACTORY.register_adapter = pooled_register_adapter  # type: ignore
+
+
+connection_pool = ConnectionPool()
@@ -1,5 +1,8 @@
+import hashlib
 import io
+import json
 import os
+import re
 import shutil
 import zipfile
 from concurrent.futures import ThreadPoolExecutor
@@ -9,7 +12,14 @@ from tempfile import TemporaryDirectory
 
 import boto3
 import requests
-
+import yaml
+from botocore.exceptions import ClientError
+
+from dbt_lambda.archive import default_part_size
+from dbt_lambda.archive import download_file
+from dbt_lambda.archive import extract_changed
+from dbt_lambda.archive import MultipartWriter
+from dbt_lambda.archive import write_archive
 from dbt_lambda.docs import get_dbt_docs_bucket
 from dbt_lambda.secrets import set_github_token_to_env
 
@@ -17,6 +27,33 @@ logger = getLogger()
 logger.setLevel('INFO')
 
 default_base_path = Path('/tmp/dbt-project')
+packages_prefix = 'packages'
+# the files that determine the installed packages, package-lock.yml pins the versions
+packages_files = ('packages.yml', 'dependencies.yml', 'package-lock.yml')
+packages_hash_file = '.packages-hash'
+
+
+def archive_marker_path(base_path: Path) -> Path:
+    """
+    The file next to the project that records the ETag and the files of the last extraction from S3.
+    """
+    return base_path.parent / f'.{base_path.name}.archive.json'
+
+
+def commit_marker_path(base_path: Path) -> Path:
+    """
+    The file next to the project that records the commit of the last copy from the repository.
+    """
+    return base_path.parent / f'.{base_path.name}.commit'
+
+
+def project_archive_key(repository_name: str | None = None, ref: str | None = None) -> str:
+    """
+    The key of the project archive in the docs bucket. Projects named in the event have their own key.
+    """
+    if repository_name is None:
+        return 'dbt-project.zip'
+    return f'projects/{repository_name}/{ref}/dbt-project.zip'
 
 
 def copy_from_repo(
@@ -24,16 +61,43 @@ def copy_from_repo(
         repository_name: str | None = None,
         ref: str | None = None,
         upload_to_s3: bool = True,
+        fetch_token: bool = True,
+        key: str = 'dbt-project.zip',
+        skip_unchanged: bool = False,
 ) -> dict:
-    set_github_token_to_env()
+    """
+    Copy the dbt project from the GitHub or CodeCommit repository.
+
+    Args:
+        base_path: The base path of the dbt project. Existing content is replaced.
+        repository_name: Defaults to the DBT_REPOSITORY_NAME environment variable.
+        ref: The branch, tag or commit. Defaults to DBT_REPOSITORY_BRANCH or 'master'.
+        upload_to_s3: Upload the project archive to the docs bucket.
+        fetch_token: Set the GitHub token from Secrets Manager before the copy.
+        key: The key of the project archive in the docs bucket.
+        skip_unchanged: Keep the existing project if the ref still points to the commit of the last copy.
+    """
+    if fetch_token:
+        set_github_token_to_env()
 
     ref = ref or os.environ.get('DBT_REPOSITORY_BRANCH', 'master')
     repository_name = repository_name or os.environ.get('DBT_REPOSITORY_NAME')
     if repository_name is None:
         raise ValueError('DBT_REPOSITORY_NAME environment variable is not set')
 
+    commit = None
+    if skip_unchanged:
+        commit = resolve_commit(repository_name, ref)
+        marker_path = commit_marker_path(base_path)
+        if commit is not None and marker_path.exists() and marker_path.read_text() == commit:
+            message = f'Project from "{repository_name}" at {ref} is unchanged ({commit})'
+            logger.info(message)
+            return {'message': message}
+
     shutil.rmtree(base_path, ignore_errors=True)
-    base_path.mkdir()
+    archive_marker_path(base_path).unlink(missing_ok=True)
+    commit_marker_path(base_path).unlink(missing_ok=True)
+    base_path.mkdir(parents=True)
 
     if os.environ.get('GITHUB_ACCESS_TOKEN'):
         copy_folder_github(base_path, repository_name=repository_name, ref=ref)
@@ -44,27 +108,75 @@ def copy_from_repo(
         copy_folder_codecommit(base_path, repository_name=repository_name, ref=ref, role_arn=role_arn)
 
     if upload_to_s3:
-        copy_to_s3(base_path)
+        copy_to_s3(base_path, key=key)
+    if commit is not None and (base_path / 'dbt_project.yml').exists():
+        commit_marker_path(base_path).write_text(commit)
 
     message = f'Copied project from "{repository_name}" at {ref}'
     logger.info(message)
     return {'message': message}
 
 
-def copy_folder_github(
-        base_path: Path,
-        repository_name: str,
-        ref: str,
-        owner: str = 'tatenmitdaten',
-):
+def github_headers() -> dict:
     token = os.environ.get('GITHUB_ACCESS_TOKEN')
     if token is None:
         raise ValueError('GITHUB_ACCESS_TOKEN environment variable is not set')
-    headers = {
+    return {
         'Authorization': f'Bearer {token}',
         "Accept": "application/vnd.github.v3+json",
         'X-GitHub-Api-Version': '2022-11-28',
     }
+
+
+def get_codecommit_client(role_arn: str | None = None):
+    if role_arn:
+        sts_client = boto3.client('sts')
+        assumed_role = sts_client.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName='AssumeRoleSession'
+        )
+        credentials = assumed_role['Credentials']
+        return boto3.client(
+            service_name='codecommit',
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken']
+        )
+    return boto3.client('codecommit')
+
+
+def resolve_commit(repository_name: str, ref: str, owner: str = 'tatenmitdaten') -> str | None:
+    """
+    Resolve a branch, tag or commit of the repository to the commit SHA.
+
+    Returns:
+        The commit SHA or None if the ref cannot be resolved.
+    """
+    if os.environ.get('GITHUB_ACCESS_TOKEN'):
+        headers = {**github_headers(), 'Accept': 'application/vnd.github.sha'}
+        url = f'https://api.github.com/repos/{owner}/{repository_name}/commits/{ref}'
+        response = requests.get(url, headers=headers)
+        if response.status_code == 200:
+            return response.text.strip()
+        logger.warning(f'Failed to resolve {ref} of "{repository_name}". Status code: {response.status_code}')
+        return None
+    client = get_codecommit_client(os.environ.get('CODECOMMIT_ROLE_ARN'))
+    try:
+        return client.get_branch(repositoryName=repository_name, branchName=ref)['branch']['commitId']
+    except client.exceptions.ClientError:
+        if re.fullmatch(r'[0-9a-f]{40}', ref):
+            return ref
+        logger.warning(f'Failed to resolve {ref} of "{repository_name}"')
+        return None
+
+
+def copy_folder_github(
+        base_path: Path,
+        repository_name: str,
+        ref: str,
+        owner: str = 'tatenmitdaten',
+):
+    headers = github_headers()
     zip_url = f'https://api.github.com/repos/{owner}/{repository_name}/zipball/{ref}'
 
     response = requests.get(zip_url, headers=headers, stream=True)
@@ -92,21 +204,7 @@ def copy_folder_codecommit(
 ):
     ignore = {'.gitignore', 'Makefile', 'make-venv.bat', '.DS_Store', 'README.md', 'docs.py', 'requirements.txt'}
 
-    if role_arn:
-        sts_client = boto3.client('sts')
-        assumed_role = sts_client.assume_role(
-            RoleArn=role_arn,
-            RoleSessionName='AssumeRoleSession'
-        )
-        credentials = assumed_role['Credentials']
-        codecommit_client = boto3.client(
-            service_name='codecommit',
-            aws_access_key_id=credentials['AccessKeyId'],
-            aws_secret_access_key=credentials['SecretAccessKey'],
-            aws_session_token=credentials['SessionToken']
-        )
-    else:
-        codecommit_client = boto3.client('codecommit')
+    codecommit_client = get_codecommit_client(role_arn)
 
     def get_files(folder_path: str = ''):
         response = codecommit_client.get_folder(
@@ -136,45 +234,167 @@ def copy_folder_codecommit(
         executor.map(download_file, get_files())
 
 
-def copy_to_s3(base_path: Path = default_base_path):
+def copy_to_s3(
+        base_path: Path = default_base_path,
+        key: str = 'dbt-project.zip',
+        compression: str | None = None,
+        compression_level: int | None = None,
+        part_size: int = default_part_size,
+):
+    """
+    Zip the project and stream the archive to the docs bucket.
+
+    Files are compressed in parallel and the archive is uploaded in parts while it is written,
+    so memory is bounded by the part size.
+
+    Args:
+        base_path: The base path of the dbt project.
+        key: The key of the archive in the docs bucket.
+        compression: One of 'stored', 'deflated' or 'bzip2'. Defaults to DBT_ARCHIVE_COMPRESSION or 'deflated'.
+        compression_level: Defaults to DBT_ARCHIVE_COMPRESSION_LEVEL or 6.
+        part_size: The size of the multipart upload parts in bytes.
+    """
     bucket = get_dbt_docs_bucket()
-    bucket.Object('dbt-project.zip').delete()
-
-    # Create zip file in memory
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(base_path):
-            for file in files:
-                file_path = Path(root) / file
-                zipf.write(file_path, file_path.relative_to(base_path.parent))
-
-    # Reset buffer position to start
-    zip_buffer.seek(0)
-
-    # Upload directly from memory
-    bucket.upload_fileobj(zip_buffer, 'dbt-project.zip')
-    logger.info(f'Zipped and uploaded {base_path} to s3://{bucket.name}/dbt-project.zip')
-
-
-def copy_from_s3(base_path: Path = default_base_path):
+    compression = compression or os.environ.get('DBT_ARCHIVE_COMPRESSION', 'deflated')
+    if compression_level is None:
+        compression_level = int(os.environ.get('DBT_ARCHIVE_COMPRESSION_LEVEL', 6))
+
+    files = (
+        (Path(root) / file, (Path(root) / file).relative_to(base_path.parent).as_posix())
+        # dbt deps links local packages into the packages directory
+        for root, _, file_names in os.walk(base_path, followlinks=True)
+        for file in sorted(file_names)
+    )
+    with MultipartWriter(bucket.meta.client, bucket.name, key, part_size=part_size) as writer:
+        size = write_archive(files, writer, method=compression, level=compression_level)
+    logger.info(f'Zipped and uploaded {base_path} to s3://{bucket.name}/{key} ({size} bytes)')
+
+
+def copy_from_s3(base_path: Path = default_base_path, key: str = 'dbt-project.zip') -> dict:
+    """
+    Download the project archive from the docs bucket and update the project incrementally.
+
+    The download is skipped if the ETag of the archive matches the last extraction into the base path.
+    Otherwise the archive is downloaded with parallel ranged requests to a temporary file and only
+    changed files are written. Files of the last extraction that are no longer in the archive are removed.
+
+    Args:
+        base_path: The base path of the dbt project.
+        key: The key of the archive in the docs bucket.
+
+    Returns:
+        The number of written, unchanged and removed files.
+    """
     bucket = get_dbt_docs_bucket()
+    client = bucket.meta.client
 
-    # Download zip file into memory
-    zip_buffer = io.BytesIO()
     try:
-        bucket.download_fileobj('dbt-project.zip', zip_buffer)
+        head = client.head_object(Bucket=bucket.name, Key=key)
     except bucket.meta.client.exceptions.ClientError as e:
-        logger.error(f'Failed to download dbt-project.zip from S3: {str(e)}')
+        logger.error(f'Failed to download {key} from S3: {str(e)}')
         raise
 
-    # Reset buffer position to start
-    zip_buffer.seek(0)
-
-    # Create base directory if it doesn't exist
-    base_path.mkdir(parents=True, exist_ok=True)
-
-    # Extract all files from zip
-    with zipfile.ZipFile(zip_buffer) as zipf:
-        zipf.extractall(base_path.parent)
-
-    logger.info(f'Downloaded and extracted dbt-project.zip to {base_path}')
+    marker_path = archive_marker_path(base_path)
+    marker = json.loads(marker_path.read_text()) if marker_path.exists() else {}
+    if marker.get('etag') == head['ETag']:
+        logger.info(f'{key} is unchanged. Using the existing project at {base_path}')
+        return {'written': 0, 'unchanged': len(marker['names']), 'removed': 0}
+
+    with TemporaryDirectory() as tmp_dir:
+        zip_path = Path(tmp_dir) / 'dbt-project.zip'
+        download_file(client, bucket.name, key, zip_path, size=head['ContentLength'], etag=head['ETag'])
+        result = extract_changed(zip_path, base_path, previous_names=marker.get('names', []))
+
+    marker_path.write_text(json.dumps({'etag': head['ETag'], 'names': result.pop('names')}))
+    logger.info(
+        f'Downloaded and extracted {key} to {base_path}: '
+        f'{result["written"]} written, {result["unchanged"]} unchanged, {result["removed"]} removed'
+    )
+    return result
+
+
+def packages_hash(base_path: Path) -> str | None:
+    """
+    The hash of the package files of the project.
+
+    Returns:
+        The hash or None if the project has no packages.
+    """
+    if not any((base_path / name).exists() for name in packages_files[:2]):
+        return None
+    digest = hashlib.sha256()
+    for name in packages_files:
+        path = base_path / name
+        if path.exists():
+            digest.update(name.encode('utf-8') + b'\0' + path.read_bytes() + b'\0')
+    return digest.hexdigest()
+
+
+def packages_install_path(base_path: Path) -> Path:
+    """
+    The directory of the installed packages, 'packages-install-path' of dbt_project.yml or dbt_packages.
+    """
+    project_file = base_path / 'dbt_project.yml'
+    config = yaml.safe_load(project_file.read_text()) if project_file.exists() else None
+    return base_path / (config or {}).get('packages-install-path', 'dbt_packages')
+
+
+def install_packages(base_path: Path = default_base_path) -> dict:
+    """
+    Install the packages of the project from the cache in the docs bucket or with dbt deps.
+
+    The installed packages are archived to the docs bucket keyed by the hash of packages.yml and
+    package-lock.yml. Packages that are already installed with the same hash are kept, otherwise they
+    are restored from the archive. Only if there is no archive for the hash, dbt deps fetches the
+    packages and the result is archived for the next copies of the project.
+
+    Args:
+        base_path: The base path of the dbt project.
+
+    Returns:
+        A message how the packages were installed.
+    """
+    package_hash = packages_hash(base_path)
+    if package_hash is None:
+        return {'message': 'Project has no packages'}
+    install_path = packages_install_path(base_path)
+    hash_path = install_path / packages_hash_file
+    if hash_path.exists() and hash_path.read_text() == package_hash:
+        message = f'Packages are unchanged ({package_hash[:12]})'
+        logger.info(message)
+        return {'message': message}
+
+    # packages of other versions are replaced as a whole
+    shutil.rmtree(install_path, ignore_errors=True)
+    archive_marker_path(install_path).unlink(missing_ok=True)
+    key = f'{packages_prefix}/{package_hash}.zip'
+    bucket = get_dbt_docs_bucket()
+    try:
+        bucket.meta.client.head_object(Bucket=bucket.name, Key=key)
+        archived = True
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+        archived = False
+    if archived:
+        copy_from_s3(install_path, key=key)
+        message = f'Restored packages from {key}'
+        logger.info(message)
+        return {'message': message}
+
+    from dbt.cli.main import dbtRunner
+
+    lock_path = base_path / 'package-lock.yml'
+    lock_exists = lock_path.exists()
+    res = dbtRunner().invoke(['deps', '--project-dir', str(base_path), '--log-level', 'none'])
+    if not res.success:
+        raise RuntimeError(f'Failed to install packages: {res.exception}')
+    if not lock_exists:
+        # deps writes a lock file, keep the package files that the hash was computed from
+        lock_path.unlink(missing_ok=True)
+    install_path.mkdir(parents=True, exist_ok=True)
+    hash_path.write_text(package_hash)
+    copy_to_s3(install_path, key=key)
+    message = f'Installed packages with dbt deps and archived them to {key}'
+    logger.info(message)
+    return {'message': message}
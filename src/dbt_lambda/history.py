@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import statistics
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from botocore.exceptions import ClientError
+
+from dbt_lambda.docs import get_dbt_docs_bucket
+from dbt_lambda.state import selection_commands
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+history_prefix = 'history'
+compacted_name = 'compacted.jsonl'
+baseline_name = 'baseline.json'
+# the maximum number of keys of a DeleteObjects request
+delete_batch_size = 1000
+# statuses of nodes whose execution time is part of the baseline
+baseline_statuses = ('success', 'pass', 'warn')
+
+
+def history_enabled() -> bool:
+    return os.environ.get('DBT_RUN_HISTORY', 'False') == 'True'
+
+
+def get_history_prefix(repository_name: str | None = None, ref: str | None = None) -> str:
+    """
+    The key prefix of the run history. Projects named in the event have their own history.
+    """
+    if repository_name is None:
+        return history_prefix
+    return f'{history_prefix}/{repository_name}/{ref}'
+
+
+def write_run(
+        run_id: str,
+        args: list[str],
+        nodes: list,
+        prefix: str = history_prefix,
+        timestamp: datetime | None = None,
+) -> str:
+    """
+    Append the node results of a run to the history in the docs bucket.
+
+    Each run is written as a JSON lines file with one record per node to the partition of its date,
+    e.g. history/date=2024-05-01/<run id>.jsonl, so concurrent runs never write the same object.
+
+    Args:
+        run_id: The id of the run.
+        args: The dbt arguments of the run.
+        nodes: The NodeResult objects of the run.
+        prefix: The key prefix of the history.
+        timestamp: The time of the run. Defaults to now.
+
+    Returns:
+        The key of the run in the docs bucket.
+    """
+    timestamp = timestamp or datetime.now(timezone.utc)
+    records = [
+        {
+            'run_id': run_id,
+            'timestamp': timestamp.isoformat(),
+            'command': args[0],
+            'unique_id': node.node_info['unique_id'],
+            'status': node.status,
+            'execution_time': node.execution_time,
+            'adapter_response': node.adapter_response,
+        }
+        for node in nodes
+    ]
+    key = f'{prefix}/date={timestamp.date().isoformat()}/{run_id}.jsonl'
+    bucket = get_dbt_docs_bucket()
+    bucket.put_object(Key=key, Body=''.join(json.dumps(record) + '\n' for record in records).encode('utf-8'))
+    logger.info(f'Wrote {len(records)} node results to s3://{bucket.name}/{key}')
+    return key
+
+
+def load_history(prefix: str = history_prefix) -> dict[str, dict]:
+    """
+    The baseline of the node execution times that the last compaction computed from the history.
+
+    Returns:
+        The median execution time and the number of runs it is based on by unique id.
+    """
+    bucket = get_dbt_docs_bucket()
+    key = f'{prefix}/{baseline_name}'
+    try:
+        body = bucket.Object(key).get()['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            logger.info(f'No history baseline found at s3://{bucket.name}/{key}')
+            return {}
+        raise
+    return json.loads(body)['nodes']
+
+
+def find_regressions(
+        execution_times: dict[str, float],
+        history: dict[str, dict],
+        factor: float | None = None,
+        min_runs: int | None = None,
+        min_duration: float = 1.0,
+) -> list[dict]:
+    """
+    Find the nodes that ran much longer than their median in the history.
+
+    Args:
+        execution_times: The execution times of the nodes of the run.
+        history: The baseline returned by load_history.
+        factor: Nodes that ran longer than factor times their median are regressions.
+            Defaults to DBT_REGRESSION_FACTOR or 1.5.
+        min_runs: Nodes with fewer runs in the history are never compared.
+            Defaults to DBT_REGRESSION_MIN_RUNS or 5.
+        min_duration: Nodes that ran shorter than this are never compared to their median.
+
+    Returns:
+        The regressions with their execution time, median, number of runs and ratio.
+    """
+    if factor is None:
+        factor = float(os.environ.get('DBT_REGRESSION_FACTOR', 1.5))
+    if min_runs is None:
+        min_runs = int(os.environ.get('DBT_REGRESSION_MIN_RUNS', 5))
+    regressions = []
+    for unique_id, execution_time in execution_times.items():
+        baseline = history.get(unique_id)
+        if baseline is None or baseline['runs'] < min_runs or execution_time < min_duration:
+            continue
+        if execution_time > factor * baseline['median']:
+            regressions.append({
+                'unique_id': unique_id,
+                'execution_time': execution_time,
+                'median': baseline['median'],
+                'runs': baseline['runs'],
+                'ratio': round(execution_time / baseline['median'], 2) if baseline['median'] else None,
+            })
+    return regressions
+
+
+def compact_history(
+        prefix: str = history_prefix,
+        runs: int | None = None,
+        days: int | None = None,
+        today: date | None = None,
+) -> dict:
+    """
+    Merge the run files of past days into one file per day and compute the baseline of the node execution times.
+
+    The partitions of past days are merged into history/date=.../compacted.jsonl. The partition of today
+    is left as is because runs may still write to it. The baseline has the median execution time of the
+    last runs of each node by the execution commands within the last days and is read by the runs to find
+    regressions.
+
+    Args:
+        prefix: The key prefix of the history.
+        runs: The number of runs per node in the baseline. Defaults to DBT_HISTORY_RUNS or 20.
+        days: The number of days of history in the baseline. Defaults to DBT_HISTORY_DAYS or 14.
+        today: The current date in UTC.
+
+    Returns:
+        A message with the number of merged run files and the number of nodes in the baseline.
+    """
+    if runs is None:
+        runs = int(os.environ.get('DBT_HISTORY_RUNS', 20))
+    if days is None:
+        days = int(os.environ.get('DBT_HISTORY_DAYS', 14))
+    today = today or datetime.now(timezone.utc).date()
+    bucket = get_dbt_docs_bucket()
+
+    def read_records(key: str) -> list[dict]:
+        body = bucket.Object(key).get()['Body'].read().decode('utf-8')
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+    partitions: dict[str, list[str]] = {}
+    for obj in bucket.objects.filter(Prefix=f'{prefix}/date='):
+        partition, _, name = obj.key[len(prefix) + 1:].partition('/')
+        partitions.setdefault(partition.removeprefix('date='), []).append(name)
+
+    merged = 0
+    for day, names in sorted(partitions.items()):
+        run_names = [name for name in names if name != compacted_name]
+        if day >= today.isoformat() or not run_names:
+            continue
+        records = [record for name in sorted(names) for record in read_records(f'{prefix}/date={day}/{name}')]
+        records.sort(key=lambda record: record['timestamp'])
+        bucket.put_object(
+            Key=f'{prefix}/date={day}/{compacted_name}',
+            Body=''.join(json.dumps(record) + '\n' for record in records).encode('utf-8'),
+        )
+        for i in range(0, len(run_names), delete_batch_size):
+            batch = run_names[i:i + delete_batch_size]
+            bucket.delete_objects(Delete={'Objects': [{'Key': f'{prefix}/date={day}/{name}'} for name in batch]})
+        partitions[day] = [compacted_name]
+        merged += len(run_names)
+        logger.info(f'Compacted {len(run_names)} runs of {day}')
+
+    since = (today - timedelta(days=days)).isoformat()
+    execution_times: dict[str, list[tuple[str, float]]] = {}
+    for day, names in partitions.items():
+        if day < since:
+            continue
+        for name in names:
+            for record in read_records(f'{prefix}/date={day}/{name}'):
+                if record['status'] in baseline_statuses and record['command'] in selection_commands:
+                    execution_times.setdefault(record['unique_id'], []).append(
+                        (record['timestamp'], record['execution_time'])
+                    )
+    nodes = {}
+    for unique_id, times in execution_times.items():
+        last = [execution_time for _, execution_time in sorted(times)[-runs:]]
+        nodes[unique_id] = {'median': statistics.median(last), 'runs': len(last)}
+    bucket.put_object(
+        Key=f'{prefix}/{baseline_name}',
+        Body=json.dumps({'updated_at': datetime.now(timezone.utc).isoformat(), 'nodes': nodes}).encode('utf-8'),
+    )
+    message = f'Compacted {merged} runs and updated the baseline of {len(nodes)} nodes'
+    logger.info(message)
+    return {'message': message, 'compacted': merged, 'baseline': len(nodes)}
@@ -5,19 +5,54 @@ import os
 import queue
 import re
 import threading
+import time
+import uuid
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from dataclasses import field
 from pathlib import Path
 
 # we only import dbt.mp_context and mock dbt.mp_context._MP_CONTEXT before any other dbt imports
 import dbt.mp_context
 from dbt.artifacts.schemas.run import RunExecutionResult
 from dbt_common.events import EventLevel
+from dbt_lambda.artifacts import cached_commands
+from dbt_lambda.connections import connection_pool
 from dbt_lambda.docs import save_index_html
 from dbt_lambda.git import copy_from_repo
 from dbt_lambda.git import copy_from_s3
 from dbt_lambda.git import default_base_path
+from dbt_lambda.git import install_packages
+from dbt_lambda.git import project_archive_key
+from dbt_lambda.history import baseline_statuses
+from dbt_lambda.history import find_regressions
+from dbt_lambda.history import get_history_prefix
+from dbt_lambda.history import history_enabled
+from dbt_lambda.history import history_prefix
+from dbt_lambda.history import load_history
+from dbt_lambda.history import write_run
+from dbt_lambda.pipeline import run_steps
+from dbt_lambda.pipeline import Step
+from dbt_lambda.profiling import compact_adapter_response
+from dbt_lambda.profiling import query_tags
+from dbt_lambda.secrets import set_github_token_to_env
 from dbt_lambda.secrets import set_snowflake_credentials_to_env
+from dbt_lambda.state import add_state_selector
+from dbt_lambda.state import download_state
+from dbt_lambda.state import filter_args
+from dbt_lambda.state import is_full_selection
+from dbt_lambda.state import project_options
+from dbt_lambda.state import selection_commands
+from dbt_lambda.state import selection_options
+from dbt_lambda.state import state_modes
+from dbt_lambda.state import state_prefix
+from dbt_lambda.state import upload_state
+from dbt_lambda.timeouts import current_watchdog
+from dbt_lambda.timeouts import find_stragglers
+from dbt_lambda.timeouts import load_baseline
+from dbt_lambda.timeouts import save_baseline
+from dbt_lambda.timeouts import watch_nodes
+from dbt_lambda.timing import span
 
 logger = logging.getLogger()
 logger.setLevel('INFO')
@@ -37,12 +72,17 @@ class CustomThreadPool:
         self.pool = ThreadPoolExecutor(max_workers=num_threads)
         self.pool_thread_initializer = pool_thread_initializer
         self.invocation_context = invocation_context
+        # enforces the node timeouts if the pool is created in a watched context
+        self.watchdog = current_watchdog.get()
 
     # provide the same interface expected by dbt.task.runnable
     def apply_async(self, func, args, callback):
         def future_callback(fut):
             return callback(fut.result())
 
+        if self.watchdog is not None and len(args) == 1 and hasattr(args[0], 'node'):
+            self.watchdog.submit(self.pool, func, args[0], callback)
+            return
         self.pool.submit(func, *args).add_done_callback(future_callback)
 
     # we would need to actually keep a "closed" attribute lying around and properly check it
@@ -51,7 +91,8 @@ class CustomThreadPool:
 
     # shutdown(wait=True) mimics "join", whereas shutdown(wait=False) mimics "terminate"
     def join(self):
-        self.pool.shutdown(wait=True)
+        # don't wait for the threads of abandoned nodes
+        self.pool.shutdown(wait=self.watchdog is None or self.watchdog.abandoned == 0)
 
 
 multiprocessing.pool.ThreadPool = CustomThreadPool  # type: ignore
@@ -77,6 +118,8 @@ class NodeResult:
     status: str
     execution_time: float
     failures: int | None
+    # the compact adapter response with e.g. the query id and the affected rows
+    adapter_response: dict = field(default_factory=dict)
 
     def __post_init__(self):
         for key in (
@@ -113,6 +156,14 @@ class NodeResult:
 class RunnerResult:
     success: bool
     nodes: list[NodeResult]
+    skipped: list[str] = field(default_factory=list)
+    stragglers: list[dict] = field(default_factory=list)
+    # the printed lines of ls and the compiled code of compile by unique id
+    output: list[str] = field(default_factory=list)
+    compiled: dict[str, str] = field(default_factory=dict)
+    # the id in the query tags of the nodes
+    run_id: str | None = None
+    regressions: list[dict] = field(default_factory=list)
 
     @property
     def as_dict(self):
@@ -146,62 +197,254 @@ class RunnerResult:
         )
 
 
-def run_single_threaded(
-        args: list[str],
-        source: str = 'repo',
-        base_path: Path | str = default_base_path
-) -> RunnerResult:
+# commands that load the manifest, the project is parsed before they are invoked
+manifest_commands = (
+    'build', 'run', 'test', 'seed', 'snapshot', 'compile', 'show',
+    'ls', 'list', 'docs', 'source', 'run-operation',
+)
+
+resource_types = {
+    'build': ['model', 'seed', 'snapshot', 'test', 'unit_test'],
+    'run': ['model'],
+    'test': ['test', 'unit_test'],
+    'seed': ['seed'],
+    'snapshot': ['snapshot'],
+}
+
+
+def list_nodes(runner, args: list[str]) -> list[str]:
     """
-    Run dbt with the given arguments in a single-threaded context.
+    List the unique ids of the nodes the dbt command would execute with the given arguments.
 
     Args:
-        args: The dbt arguments to run.
-        source: The source of the dbt project. Either 'repo' or 's3'.
-        base_path: The base path of the dbt project.
+        runner: A dbtRunner with a parsed manifest.
+        args: The dbt arguments of a command that accepts a node selection.
+            Commands without known resource types list all resource types.
 
     Returns:
-        A RunnerResult object with the success flag and a list of NodeResult objects.
+        The unique ids of the selected nodes.
+    """
+    ls_args = ['ls', *filter_args(args, selection_options + project_options)]
+    for resource_type in resource_types.get(args[0], []):
+        ls_args.extend(['--resource-type', resource_type])
+    res = runner.invoke(ls_args + ['--output', 'json', '--output-keys', 'unique_id', '--log-level', 'none'])
+    if res.exception:
+        raise RuntimeError(f'Failed to run {" ".join(ls_args)}: {res.exception}')
+    return [json.loads(node)['unique_id'] for node in res.result]
+
+
+def setup_steps(
+        source: str,
+        base_path: Path,
+        repository_name: str | None = None,
+        ref: str | None = None,
+) -> list[Step]:
+    """
+    The network-bound setup steps before dbt starts. They run concurrently.
     """
+    steps = []
+    key = project_archive_key(repository_name, ref)
+    if source == 'repo':
+        steps.extend([
+            Step('github_token', set_github_token_to_env),
+            Step('copy', lambda: copy_from_repo(
+                base_path,
+                repository_name=repository_name,
+                ref=ref,
+                fetch_token=False,
+                key=key,
+                skip_unchanged=repository_name is not None,
+            ), depends_on=('github_token',)),
+        ])
+    elif source == 's3':
+        steps.append(Step('copy', lambda: copy_from_s3(base_path, key=key)))
+    else:
+        logger.info(f'No source parameter provided. Using the existing project at {base_path}')
+        steps.append(Step('copy', lambda: None))
+    if source in ('repo', 's3'):
+        # an existing local project is used as it is
+        steps.append(Step('packages', lambda: install_packages(base_path), depends_on=('copy',)))
+    steps.append(Step('secrets', lambda: set_snowflake_credentials_to_env()))
+    return steps
+
+
+def check_threaded_context():
     import dbt.graph.thread_pool
 
     # Ensure that the threaded context and pook are set
     assert isinstance(dbt.mp_context._MP_CONTEXT, ThreadedContext)
     assert issubclass(dbt.graph.thread_pool.ThreadPool, CustomThreadPool)
 
-    # Import dbt modules after the threaded context has been set
-    from dbt.cli.main import dbtRunner, dbtRunnerResult
 
+def log_event(event):
+    info = event.info
+    if info.level in (
+            EventLevel.INFO,
+            EventLevel.WARN,
+            EventLevel.ERROR
+    ):
+        # remove ANSI color codes
+        clean_msg = re.sub(r'\x1b\[[0-9;]*m', '', info.msg)
+        logger.info(clean_msg)
+
+
+@dataclass
+class Project:
+    base_path: Path
+    state_prefix: str = state_prefix
+    history_prefix: str = history_prefix
+    # parsed manifests by the project options they were parsed with
+    manifests: dict[tuple[str, ...], object] = field(default_factory=dict)
+
+
+def prepare_project(
+        source: str = 'repo',
+        base_path: Path | str = default_base_path,
+        repository_name: str | None = None,
+        ref: str | None = None,
+) -> Project:
+    """
+    Copy the dbt project from the source, set the credentials and point dbt to the project.
+
+    Args:
+        source: The source of the dbt project. Either 'repo' or 's3'.
+        base_path: The base path of the dbt project.
+        repository_name: The repository of the dbt project. Defaults to the DBT_REPOSITORY_NAME environment variable.
+            Projects of a named repository have their own archive and state in the docs bucket.
+        ref: The branch, tag or commit of the repository.
+
+    Returns:
+        The prepared project. Commands invoked on the same project share its parsed manifests.
+    """
+    check_threaded_context()
     os.environ['DBT_SEND_ANONYMOUS_USAGE_STATS'] = 'False'
     base_path = Path(base_path).absolute()
+    if repository_name is not None:
+        ref = ref or os.environ.get('DBT_REPOSITORY_BRANCH', 'master')
 
-    # Copy the project from the source
-    if source == 'repo':
-        copy_from_repo(base_path)
-    elif source == 's3':
-        copy_from_s3(base_path)
-    else:
-        logger.info(f'No source parameter provided. Using the existing project at {base_path}')
+    # Copy the project from the source and set the Snowflake credentials to environment variables
+    run_steps(setup_steps(source, base_path, repository_name, ref))
 
     os.environ['DBT_PROJECT_DIR'] = base_path.__str__()
     logger.info(f'Using project dir: {os.environ["DBT_PROJECT_DIR"]}')
     os.environ['DBT_PROFILES_DIR'] = (base_path / 'profiles').__str__()
     logger.info(f'Using profiles dir: {os.environ["DBT_PROFILES_DIR"]}')
 
-    # Set Snowflake credentials to environment variables
-    set_snowflake_credentials_to_env()
+    # Keep warehouse connections open between invocations in a warm container
+    connection_pool.configure(
+        enabled=os.environ.get('DBT_KEEP_CONNECTIONS', 'False') == 'True',
+        idle_timeout=float(os.environ.get('DBT_CONNECTION_IDLE_TIMEOUT', 300)),
+    )
+    return Project(
+        base_path=base_path,
+        state_prefix=state_prefix if repository_name is None else f'{state_prefix}/{repository_name}/{ref}',
+        history_prefix=get_history_prefix(repository_name, ref),
+    )
 
-    def log_event(event):
-        info = event.info
-        if info.level in (
-                EventLevel.INFO,
-                EventLevel.WARN,
-                EventLevel.ERROR
-        ):
-            # remove ANSI color codes
-            clean_msg = re.sub(r'\x1b\[[0-9;]*m', '', info.msg)
-            logger.info(clean_msg)
 
-    res: dbtRunnerResult = dbtRunner(callbacks=[log_event]).invoke(args + ['--log-level', 'none'])
+def parse_project(project: Project, args: list[str]):
+    """
+    Parse the project with the project options of the dbt arguments. The manifest is parsed once per options.
+    """
+    from dbt.cli.main import dbtRunner
+
+    options = tuple(filter_args(args, project_options))
+    if options not in project.manifests:
+        with span('parse'):
+            res = dbtRunner(callbacks=[log_event]).invoke(['parse', *options, '--log-level', 'none'])
+        if res.exception:
+            raise RuntimeError(f'Failed to run {" ".join(args)}: {res.exception}')
+        project.manifests[options] = res.result
+    return project.manifests[options]
+
+
+def select_nodes(project: Project, args: list[str]) -> list[str]:
+    """
+    List the unique ids of the nodes the dbt command would execute on the prepared project.
+    """
+    from dbt.cli.main import dbtRunner
+
+    runner = dbtRunner(manifest=parse_project(project, args), callbacks=[log_event])
+    return list_nodes(runner, args)
+
+
+def invoke_command(project: Project, args: list[str], state: str | None = None) -> RunnerResult:
+    """
+    Invoke a dbt command on a prepared project.
+
+    Args:
+        project: The project returned by prepare_project.
+        args: The dbt arguments to run.
+        state: The state mode, see run_single_threaded.
+
+    Returns:
+        A RunnerResult object with the success flag and a list of NodeResult objects.
+    """
+    # Import dbt modules after the threaded context has been set
+    from dbt.cli.main import dbtRunner, dbtRunnerResult
+
+    if state is not None and state not in state_modes:
+        raise ValueError(f'Unknown state mode "{state}". Choose from {", ".join(state_modes)}.')
+
+    base_path = project.base_path
+    prefix = project.state_prefix
+    # the state selectors restrict the selection, the published manifest depends on the requested one.
+    # fresher runs only publish sources.json, the nodes without fresher sources are never built.
+    publish_manifest = state in ('publish', 'slim') and is_full_selection(args)
+    runner = dbtRunner(callbacks=[log_event])
+    res: dbtRunnerResult
+    selected: list[str] = []
+    if state is not None or args[0] in manifest_commands:
+        # parse once and reuse the manifest for listing and execution
+        runner = dbtRunner(manifest=parse_project(project, args), callbacks=[log_event])
+
+    if state == 'slim' and args[0] in selection_commands:
+        with span('state'):
+            state_path = download_state(base_path, prefix=prefix)
+            if state_path is None:
+                logger.info('No published manifest found. Running the full selection.')
+            else:
+                selected = list_nodes(runner, args)
+                args = add_state_selector(args, 'state:modified+', state_path)
+                logger.info(f'Running slim selection: {" ".join(args)}')
+
+    published = ['manifest.json']
+    if state == 'fresher' and args[0] in selection_commands:
+        with span('freshness'):
+            state_path = download_state(base_path, files=('sources.json',), prefix=prefix)
+            freshness_args = ['source', 'freshness', *filter_args(args, project_options)]
+            res = runner.invoke(freshness_args + ['--log-level', 'none'])
+            if res.exception:
+                raise RuntimeError(f'Failed to run {" ".join(freshness_args)}: {res.exception}')
+            published.append('sources.json')
+            if state_path is None:
+                logger.info('No published sources.json found. Running the full selection.')
+            else:
+                selected = list_nodes(runner, args)
+                args = add_state_selector(args, 'source_status:fresher+', state_path, defer=False)
+                logger.info(f'Running selection with fresher sources: {" ".join(args)}')
+    elif state is not None and args[:2] == ['source', 'freshness']:
+        published.append('sources.json')
+
+    baseline = load_baseline(base_path, args[0])
+    history = {}
+    # only the node results of execution commands are comparable, compile and show don't materialize the nodes
+    recorded = history_enabled() and args[0] in selection_commands
+    if recorded:
+        with span('baseline'):
+            history = load_history(project.history_prefix)
+        # the median of the history is a more robust baseline than the previous run
+        baseline.update({unique_id: node['median'] for unique_id, node in history.items()})
+    run_id = str(uuid.uuid4())
+    logger.info(f'Run id: {run_id}')
+    with span('execute'), watch_nodes() as watchdog, query_tags(runner.manifest, run_id) as tagged:
+        res = runner.invoke(args + ['--log-level', 'none'])
+    manifest_path = base_path / 'target' / 'manifest.json'
+    manifest_published = publish_manifest or args[0] in cached_commands
+    if tagged and manifest_published and runner.manifest is not None and manifest_path.exists():
+        # the published state and the cached artifacts must not have the query tags of this run
+        with span('manifest'):
+            runner.manifest.write(str(manifest_path))
 
     if res.exception:
         message = res.exception.__str__()
@@ -209,19 +452,150 @@ def run_single_threaded(
 
     runner_result = RunnerResult(
         success=res.success,
-        nodes=[]
+        nodes=[],
+        run_id=run_id,
     )
     if 'docs' in args:
-        save_index_html()
+        with span('docs'):
+            save_index_html()
+    if isinstance(res.result, list):
+        runner_result.output = [str(line) for line in res.result]
     if isinstance(res.result, RunExecutionResult):
+        if args[0] == 'compile':
+            runner_result.compiled = {
+                node.node.unique_id: compiled_code for node in res.result.results
+                if (compiled_code := getattr(node.node, 'compiled_code', None)) is not None
+            }
         for node in res.result.results:
             runner_result.nodes.append(
                 NodeResult(
                     node_info=node.node.node_info,
-                    status=node.status.lower(),
+                    status='timeout' if node.node.unique_id in watchdog.timed_out else node.status.lower(),
                     execution_time=node.execution_time,
-                    failures=node.failures
+                    failures=node.failures,
+                    adapter_response=compact_adapter_response(node.adapter_response),
                 )
             )
+    execution_times = {node.node_info['unique_id']: node.execution_time for node in runner_result.nodes}
+    runner_result.stragglers = find_stragglers(execution_times, baseline, watchdog.soft_timed_out)
+    if runner_result.stragglers:
+        logger.info(f'Found {len(runner_result.stragglers)} stragglers')
+    save_baseline(base_path, args[0], {
+        node.node_info['unique_id']: node.execution_time for node in runner_result.nodes
+        if node.status in baseline_statuses
+    })
+    if recorded and runner_result.nodes:
+        runner_result.regressions = find_regressions(execution_times, history)
+        if runner_result.regressions:
+            logger.info(f'Found {len(runner_result.regressions)} regressions')
+        with span('history'):
+            write_run(run_id, args, runner_result.nodes, prefix=project.history_prefix)
+    if selected:
+        executed = {node.node_info['unique_id'] for node in runner_result.nodes}
+        runner_result.skipped = [unique_id for unique_id in selected if unique_id not in executed]
+        logger.info(f'Skipped {len(runner_result.skipped)} unchanged nodes')
+    if state is not None and res.success:
+        with span('publish'):
+            if publish_manifest:
+                upload_state(base_path, prefix=prefix)
+            if 'sources.json' in published and (base_path / 'target' / 'sources.json').exists():
+                upload_state(base_path, files=('sources.json',), keep_previous=True, prefix=prefix)
 
     return runner_result
+
+
+def run_single_threaded(
+        args: list[str],
+        source: str = 'repo',
+        base_path: Path | str = default_base_path,
+        state: str | None = None,
+        repository_name: str | None = None,
+        ref: str | None = None,
+) -> RunnerResult:
+    """
+    Run dbt with the given arguments in a single-threaded context.
+
+    Args:
+        args: The dbt arguments to run.
+        source: The source of the dbt project. Either 'repo' or 's3'.
+        base_path: The base path of the dbt project.
+        state: Either 'publish' to publish the manifest to the docs bucket after a successful run,
+            'slim' to additionally restrict the selection to 'state:modified+' of the published manifest
+            or 'fresher' to run 'source freshness' first and restrict the selection to 'source_status:fresher+'
+            compared to the published sources.json.
+        repository_name: The repository of the dbt project. Defaults to the DBT_REPOSITORY_NAME environment variable.
+            Projects of a named repository have their own archive and state in the docs bucket.
+        ref: The branch, tag or commit of the repository.
+
+    Returns:
+        A RunnerResult object with the success flag and a list of NodeResult objects.
+    """
+    if state is not None and state not in state_modes:
+        raise ValueError(f'Unknown state mode "{state}". Choose from {", ".join(state_modes)}.')
+    project = prepare_project(source, base_path, repository_name, ref)
+    return invoke_command(project, args, state)
+
+
+@dataclass
+class Command:
+    args: list[str]
+    continue_on_error: bool = False
+    state: str | None = None
+
+
+@dataclass
+class CommandResult:
+    args: list[str]
+    result: RunnerResult | None = None
+    error: str | None = None
+    wall_time: float = 0
+
+    @property
+    def success(self) -> bool:
+        return self.error is None and self.result is not None and self.result.success
+
+
+def run_commands(
+        commands: list[Command],
+        source: str = 'repo',
+        base_path: Path | str = default_base_path,
+        repository_name: str | None = None,
+        ref: str | None = None,
+) -> list[CommandResult]:
+    """
+    Run several dbt commands in order on one copy of the project.
+
+    The project is copied once and parsed once per project options. A failed command stops the
+    remaining commands unless continue_on_error is set for it.
+
+    Args:
+        commands: The commands in their order.
+        source: The source of the dbt project. Either 'repo' or 's3'.
+        base_path: The base path of the dbt project.
+        repository_name: The repository of the dbt project.
+        ref: The branch, tag or commit of the repository.
+
+    Returns:
+        The results of the commands that were run.
+    """
+    for command in commands:
+        if command.state is not None and command.state not in state_modes:
+            raise ValueError(f'Unknown state mode "{command.state}". Choose from {", ".join(state_modes)}.')
+    project = prepare_project(source, base_path, repository_name, ref)
+    results = []
+    for i, command in enumerate(commands):
+        command_result = CommandResult(args=command.args)
+        start = time.perf_counter()
+        with span(f'step-{i}'):
+            try:
+                command_result.result = invoke_command(project, command.args, command.state)
+            except Exception as e:
+                # e.g. a failed state download, the results of the previous commands are still returned
+                logger.exception(e)
+                command_result.error = str(e)
+        command_result.wall_time = time.perf_counter() - start
+        results.append(command_result)
+        if not command_result.success and not command.continue_on_error:
+            logger.info(f'Stopping after failed command {" ".join(command.args)}')
+            break
+    return results
@@ -0,0 +1,64 @@
+import contextvars
+import logging
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from dataclasses import dataclass
+from typing import Any
+from typing import Callable
+
+from dbt_lambda.timing import span
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+
+class DependencyFailedError(Exception):
+    pass
+
+
+@dataclass
+class Step:
+    name: str
+    func: Callable[[], Any]
+    depends_on: tuple[str, ...] = ()
+
+
+def run_steps(steps: list[Step]) -> dict[str, Any]:
+    """
+    Run the steps concurrently. Each step starts as soon as the steps it depends on have finished.
+
+    All steps are awaited before an error is raised. The error of the first failed step in the
+    given order is raised, so errors surface as if the steps had run one after the other.
+
+    Args:
+        steps: The steps in their sequential order. Dependencies must precede their dependents.
+
+    Returns:
+        The return values of the steps by name.
+    """
+    futures: dict[str, Future] = {}
+
+    def run_step(step: Step) -> Any:
+        for name in step.depends_on:
+            if futures[name].exception() is not None:
+                raise DependencyFailedError(f'Step "{step.name}" depends on failed step "{name}"')
+        with span(step.name):
+            return step.func()
+
+    # one worker per step, steps that wait for their dependencies must not block other steps
+    with ThreadPoolExecutor(max_workers=max(len(steps), 1)) as executor:
+        for step in steps:
+            unknown = set(step.depends_on) - set(futures)
+            if unknown:
+                raise ValueError(f'Step "{step.name}" depends on unknown steps {sorted(unknown)}')
+            # run in a copy of the current context to record the spans on the current timings
+            context = contextvars.copy_context()
+            futures[step.name] = executor.submit(context.run, run_step, step)
+        wait(futures.values())
+
+    for step in steps:
+        error = futures[step.name].exception()
+        if error is not None and not isinstance(error, DependencyFailedError):
+            raise error
+    return {name: future.result() for name, future in futures.items()}
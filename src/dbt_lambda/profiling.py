@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+from contextlib import contextmanager
+from typing import Iterator
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+# keys of the adapter responses that measure the data a query processed, in order of preference
+volume_keys = ('bytes_processed', 'bytes_scanned', 'bytes_billed', 'rows_affected')
+
+
+def compact_adapter_response(adapter_response: dict | None) -> dict:
+    """
+    The adapter response of a node without the status message and empty values,
+    e.g. the query id and the affected rows on Snowflake or the processed bytes on BigQuery.
+    """
+    return {
+        key: value for key, value in (adapter_response or {}).items()
+        if not key.startswith('_') and value is not None and value != -1
+    }
+
+
+def node_volume(adapter_response: dict) -> tuple[str, float] | None:
+    for key in volume_keys:
+        if isinstance(adapter_response.get(key), (int, float)):
+            return key, adapter_response[key]
+    return None
+
+
+def top_nodes(nodes: list, n: int | None = None) -> dict[str, list[dict]]:
+    """
+    The slowest nodes and the nodes that processed the most data.
+
+    Args:
+        nodes: The NodeResult objects of a run.
+        n: The number of nodes per list. Defaults to DBT_TOP_NODES or 5.
+
+    Returns:
+        The 'slowest' nodes by execution time and the 'heaviest' nodes by processed bytes or affected rows.
+    """
+    if n is None:
+        n = int(os.environ.get('DBT_TOP_NODES', 5))
+
+    def summary(node) -> dict:
+        return {
+            'unique_id': node.node_info['unique_id'],
+            'execution_time': node.execution_time,
+            **node.adapter_response,
+        }
+
+    slowest = sorted(nodes, key=lambda node: node.execution_time, reverse=True)[:n]
+    measured = [(node, volume) for node in nodes if (volume := node_volume(node.adapter_response)) is not None]
+    heaviest = sorted(measured, key=lambda item: item[1][1], reverse=True)[:n]
+    summaries = {'slowest': [summary(node) for node in slowest]}
+    if heaviest:
+        summaries['heaviest'] = [summary(node) for node, _ in heaviest]
+    return summaries
+
+
+def query_tag(run_id: str, unique_id: str, original: str | None = None) -> str:
+    tag = {'run_id': run_id, 'unique_id': unique_id}
+    if original:
+        tag['query_tag'] = original
+    return json.dumps(tag, separators=(',', ':'))
+
+
+@contextmanager
+def query_tags(manifest, run_id: str) -> Iterator[bool]:
+    """
+    Tag the queries of each node with the run id and the unique id of the node while the manifest is invoked.
+
+    The tag is set as the query_tag config of the nodes, so the warehouse query history can be joined
+    with the results of the run. The configured query tag of a node is kept in the tag. Enabled by
+    DBT_QUERY_TAGS, which defaults to True.
+
+    Args:
+        manifest: The parsed manifest that is invoked. The configs of its nodes are restored afterwards.
+        run_id: The id of the run.
+
+    Returns:
+        True if the nodes were tagged. The manifest.json that dbt wrote meanwhile has the tags of the run.
+    """
+    if manifest is None or os.environ.get('DBT_QUERY_TAGS', 'True') != 'True':
+        yield False
+        return
+    originals = {}
+    for node in manifest.nodes.values():
+        original = node.config.get('query_tag')
+        originals[node.unique_id] = original
+        node.config['query_tag'] = query_tag(run_id, node.unique_id, original)
+    try:
+        yield True
+    finally:
+        for unique_id, original in originals.items():
+            config = manifest.nodes[unique_id].config
+            if hasattr(config, 'query_tag'):
+                config.query_tag = original
+            elif original is None:
+                config._extra.pop('query_tag', None)
+            else:
+                config._extra['query_tag'] = original
@@ -1,5 +1,6 @@
 import json
 import os
+import threading
 from functools import lru_cache
 from typing import Optional
 
@@ -9,6 +10,23 @@ from logging import getLogger
 logger = getLogger()
 logger.setLevel('INFO')
 
+secrets_client_lock = threading.Lock()
+
+
+def get_secrets_client():
+    """
+    The Secrets Manager client of the container, created once on its own session.
+
+    Secrets are fetched concurrently and boto3 sessions are not thread-safe, so the client is created under a lock.
+    """
+    with secrets_client_lock:
+        return _create_secrets_client()
+
+
+@lru_cache
+def _create_secrets_client():
+    return boto3.session.Session().client('secretsmanager')
+
 
 @lru_cache
 def get_secret(secret_id) -> dict:
@@ -21,8 +39,7 @@ def get_secret(secret_id) -> dict:
     Returns:
         Secret as a dictionary
     """
-    client = boto3.client('secretsmanager')
-    secret_str = client.get_secret_value(SecretId=secret_id)['SecretString']
+    secret_str = get_secrets_client().get_secret_value(SecretId=secret_id)['SecretString']
     secret = json.loads(secret_str)
     return secret
 
@@ -0,0 +1,137 @@
+import logging
+from pathlib import Path
+
+from botocore.exceptions import ClientError
+
+from dbt_lambda.docs import get_dbt_docs_bucket
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+state_prefix = 'state'
+state_modes = ('publish', 'slim', 'fresher')
+
+# commands that accept a node selection and can be deferred to the state manifest
+selection_commands = ('build', 'run', 'test', 'seed', 'snapshot')
+selection_options = ('--select', '-s', '--models', '-m', '--exclude', '--selector')
+project_options = ('--vars', '--target', '-t', '--profile', '--project-dir', '--profiles-dir', '--target-path')
+
+
+def download_state(
+        base_path: Path,
+        files: tuple[str, ...] = ('manifest.json',),
+        prefix: str = state_prefix,
+) -> Path | None:
+    """
+    Download the published dbt artifacts from the docs bucket into the state directory of the project.
+
+    Args:
+        base_path: The base path of the dbt project.
+        files: The artifacts to download.
+        prefix: The key prefix of the published artifacts.
+
+    Returns:
+        The state directory or None if any of the artifacts has not been published yet.
+    """
+    bucket = get_dbt_docs_bucket()
+    state_path = base_path / 'state'
+    state_path.mkdir(parents=True, exist_ok=True)
+    for file in files:
+        key = f'{prefix}/{file}'
+        try:
+            bucket.download_file(key, str(state_path / file))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                logger.info(f'No state found at s3://{bucket.name}/{key}')
+                return None
+            raise
+        logger.info(f'Downloaded s3://{bucket.name}/{key} to {state_path}')
+    return state_path
+
+
+def upload_state(
+        base_path: Path,
+        files: tuple[str, ...] = ('manifest.json',),
+        keep_previous: bool = False,
+        prefix: str = state_prefix,
+):
+    """
+    Publish dbt artifacts from the target directory of the project to the docs bucket.
+
+    Args:
+        base_path: The base path of the dbt project.
+        files: The artifacts to upload.
+        keep_previous: Keep the currently published artifact as '<name>-previous.json'.
+        prefix: The key prefix of the published artifacts.
+    """
+    bucket = get_dbt_docs_bucket()
+    for file in files:
+        key = f'{prefix}/{file}'
+        if keep_previous:
+            previous_key = f'{prefix}/{Path(file).stem}-previous{Path(file).suffix}'
+            try:
+                bucket.copy({'Bucket': bucket.name, 'Key': key}, previous_key)
+                logger.info(f'Copied s3://{bucket.name}/{key} to {previous_key}')
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                    raise
+        bucket.upload_file(str(base_path / 'target' / file), key)
+        logger.info(f'Uploaded {file} to s3://{bucket.name}/{key}')
+
+
+def filter_args(args: list[str], options: tuple[str, ...]) -> list[str]:
+    """
+    Return the given options with their values from the dbt arguments.
+    """
+    filtered = []
+    keep = False
+    for arg in args:
+        if arg.startswith('-'):
+            keep = arg in options
+        if keep:
+            filtered.append(arg)
+    return filtered
+
+
+def is_full_selection(args: list[str]) -> bool:
+    """
+    Whether the dbt arguments execute all nodes of an execution command. Only the manifest of such a run
+    can be published as state, the modified nodes outside of a restricted selection were never built.
+    """
+    return args[0] in selection_commands and not filter_args(args, selection_options)
+
+
+def add_state_selector(args: list[str], selector: str, state_path: Path, defer: bool = True) -> list[str]:
+    """
+    Restrict the selection of the dbt arguments to the given state selector.
+
+    Every selected criterion is intersected with the state selector. If nothing is selected,
+    the state selector becomes the selection.
+
+    Args:
+        args: The dbt arguments.
+        selector: A state selector, e.g. 'state:modified+'.
+        state_path: The directory with the state artifacts.
+        defer: Defer unselected upstream nodes to the state manifest.
+
+    Returns:
+        The dbt arguments with the state selector and the state options.
+    """
+    new_args = []
+    in_select = False
+    selected = False
+    for arg in args:
+        if arg.startswith('-'):
+            in_select = arg in ('--select', '-s', '--models', '-m')
+            selected = selected or in_select
+            new_args.append(arg)
+        elif in_select:
+            new_args.append(f'{arg},{selector}')
+        else:
+            new_args.append(arg)
+    if not selected:
+        new_args.extend(['--select', selector])
+    new_args.extend(['--state', str(state_path)])
+    if defer:
+        new_args.append('--defer')
+    return new_args
@@ -0,0 +1,307 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Iterator
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+# keys in the meta of a node that override the timeouts of the environment
+soft_timeout_key = 'soft_timeout'
+hard_timeout_key = 'hard_timeout'
+
+
+@dataclass
+class NodeTimeouts:
+    soft: float | None = None
+    hard: float | None = None
+
+
+def get_node_timeouts(node) -> NodeTimeouts:
+    """
+    The timeouts of a node from its meta or the DBT_NODE_SOFT_TIMEOUT and DBT_NODE_HARD_TIMEOUT environment variables.
+    """
+    meta = {**getattr(node, 'meta', {}), **getattr(getattr(node, 'config', None), 'meta', {})}
+
+    def timeout(key: str, env_var: str) -> float | None:
+        value = meta.get(key, os.environ.get(env_var))
+        return float(value) if value not in (None, '') else None
+
+    return NodeTimeouts(
+        soft=timeout(soft_timeout_key, 'DBT_NODE_SOFT_TIMEOUT'),
+        hard=timeout(hard_timeout_key, 'DBT_NODE_HARD_TIMEOUT'),
+    )
+
+
+@dataclass
+class RunningNode:
+    unique_id: str
+    pool: Any
+    runner: Any
+    callback: Callable
+    timeouts: NodeTimeouts
+    started_at: float | None = None
+    thread_id: int | None = None
+    connection: Any = None
+    cancelled_at: float | None = None
+    delivered: bool = False
+
+
+class Watchdog:
+    """
+    Watches the nodes running in the thread pool and enforces their timeouts.
+
+    A node that runs longer than its soft timeout is reported as a straggler. A node that runs longer
+    than its hard timeout is cancelled at the warehouse and marked as timed out, so its dependents are
+    skipped and the rest of the DAG keeps running. If the worker doesn't return within the grace period
+    after the cancellation, the node is released with an error result and its thread is abandoned.
+    """
+
+    def __init__(self, poll_interval: float = 0.5, grace_period: float = 30):
+        self.poll_interval = poll_interval
+        self.grace_period = grace_period
+        self.lock = threading.Lock()
+        self.running: dict[str, RunningNode] = {}
+        self.timed_out: dict[str, float] = {}
+        self.soft_timed_out: dict[str, float] = {}
+        self.abandoned = 0
+        self.stopped = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def submit(self, pool, func: Callable, runner, callback: Callable):
+        """
+        Submit the runner of a node to the thread pool and deliver its result once to the callback.
+        """
+        entry = RunningNode(
+            unique_id=runner.node.unique_id,
+            pool=pool,
+            runner=runner,
+            callback=callback,
+            timeouts=get_node_timeouts(runner.node),
+        )
+        watched = entry.timeouts.soft is not None or entry.timeouts.hard is not None
+        if watched:
+            self.start()
+
+        def run():
+            entry.thread_id = threading.get_ident()
+            entry.started_at = time.monotonic()
+            if watched:
+                with self.lock:
+                    self.running[entry.unique_id] = entry
+            try:
+                return func(runner)
+            finally:
+                with self.lock:
+                    self.running.pop(entry.unique_id, None)
+
+        def future_callback(fut):
+            result = fut.result()
+            if entry.unique_id in self.timed_out:
+                result.message = f'Timed out after {self.timed_out[entry.unique_id]:g}s: {result.message}'
+            self.deliver(entry, result)
+
+        pool.submit(run).add_done_callback(future_callback)
+
+    def deliver(self, entry: RunningNode, result):
+        with self.lock:
+            if entry.delivered:
+                logger.info(f'Dropping late result of abandoned node {entry.unique_id}')
+                return
+            entry.delivered = True
+        entry.callback(result)
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.watch, name='dbt-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def watch(self):
+        while not self.stopped.wait(self.poll_interval):
+            with self.lock:
+                entries = list(self.running.values())
+            for entry in entries:
+                self.check(entry)
+
+    def check(self, entry: RunningNode):
+        if entry.started_at is None:
+            return
+        now = time.monotonic()
+        elapsed = now - entry.started_at
+        timeouts = entry.timeouts
+        if timeouts.soft is not None and elapsed > timeouts.soft and entry.unique_id not in self.soft_timed_out:
+            self.soft_timed_out[entry.unique_id] = timeouts.soft
+            logger.warning(f'Node {entry.unique_id} is still running after its soft timeout of {timeouts.soft:g}s')
+        if timeouts.hard is not None and elapsed > timeouts.hard and entry.cancelled_at is None:
+            entry.cancelled_at = now
+            self.timed_out[entry.unique_id] = timeouts.hard
+            logger.warning(f'Cancelling node {entry.unique_id} after its hard timeout of {timeouts.hard:g}s')
+            connections = entry.runner.adapter.connections
+            entry.connection = connections.thread_connections.get((os.getpid(), entry.thread_id))
+            self.cancel(entry)
+        elif entry.cancelled_at is not None and now - entry.cancelled_at > self.grace_period:
+            with self.lock:
+                self.running.pop(entry.unique_id, None)
+            self.abandon(entry, elapsed)
+
+    @staticmethod
+    def cancel(entry: RunningNode):
+        connection = entry.connection
+        if connection is None or connection.handle is None:
+            logger.info(f'No open connection to cancel for node {entry.unique_id}')
+            return
+        try:
+            # adapters like dbt-snowflake run the cancel query on a connection of the calling thread
+            with entry.runner.adapter.connection_named('watchdog'):
+                entry.runner.adapter.connections.cancel(connection)
+        except Exception as e:
+            logger.warning(f'Failed to cancel the query of node {entry.unique_id}: {e}')
+
+    def abandon(self, entry: RunningNode, elapsed: float):
+        from dbt.artifacts.schemas.run import RunResult
+        from dbt.artifacts.schemas.results import RunStatus
+
+        logger.warning(f'Abandoning node {entry.unique_id} that did not return after it was cancelled')
+        self.abandoned += 1
+        # replace the worker that is blocked by the abandoned node, the executor only starts workers on submit
+        entry.pool._max_workers += 1
+        entry.pool.submit(lambda: None)
+        # detach the connection of the node, closing it at the end of the invocation would block on the running query
+        connections = entry.runner.adapter.connections
+        with connections.lock:
+            connections.thread_connections.pop((os.getpid(), entry.thread_id), None)
+        self.deliver(entry, RunResult(
+            status=RunStatus.Error,  # type: ignore
+            timing=[],
+            thread_id='',
+            execution_time=elapsed,
+            adapter_response={},
+            message=f'Timed out after {self.timed_out[entry.unique_id]:g}s',
+            failures=None,
+            batch_results=None,
+            node=entry.runner.node,
+        ))
+
+
+current_watchdog: ContextVar[Watchdog | None] = ContextVar('current_watchdog', default=None)
+
+
+@contextmanager
+def watch_nodes(poll_interval: float = 0.5, grace_period: float | None = None) -> Iterator[Watchdog]:
+    """
+    Enforce the node timeouts of the thread pools created in the current context.
+
+    Args:
+        poll_interval: Seconds between the checks of the running nodes.
+        grace_period: Seconds to wait for a cancelled node before it is abandoned.
+            Defaults to DBT_NODE_CANCEL_GRACE_PERIOD or 30.
+    """
+    if grace_period is None:
+        grace_period = float(os.environ.get('DBT_NODE_CANCEL_GRACE_PERIOD', 30))
+    watchdog = Watchdog(poll_interval=poll_interval, grace_period=grace_period)
+    token = current_watchdog.set(watchdog)
+    try:
+        yield watchdog
+    finally:
+        current_watchdog.reset(token)
+        watchdog.stop()
+
+
+def get_baselines_root() -> Path:
+    """
+    The directory of the baselines of the stragglers, /tmp/dbt-baselines on AWS Lambda.
+    """
+    return Path(os.environ.get('DBT_BASELINES_ROOT', Path(tempfile.gettempdir()) / 'dbt-baselines'))
+
+
+def baseline_path(base_path: Path, command: str) -> Path:
+    # the baseline is kept outside of the project, copying the project replaces its target directory
+    project_key = hashlib.sha256(str(Path(base_path).absolute()).encode('utf-8')).hexdigest()[:16]
+    return get_baselines_root() / project_key / f'{command}.json'
+
+
+def load_baseline(base_path: Path, command: str) -> dict[str, float]:
+    """
+    The execution times of the nodes in the previous runs of the command in the project.
+    """
+    path = baseline_path(base_path, command)
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text())
+    except ValueError as e:
+        logger.warning(f'Failed to read the baseline from {path}: {e}')
+        return {}
+
+
+def save_baseline(base_path: Path, command: str, execution_times: dict[str, float]):
+    """
+    Update the baseline of the command with the execution times of the nodes of a run.
+
+    Nodes that were not part of the run keep their previous execution time.
+    """
+    if not execution_times:
+        return
+    path = baseline_path(base_path, command)
+    baseline = {**load_baseline(base_path, command), **execution_times}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(baseline))
+
+
+def find_stragglers(
+        execution_times: dict[str, float],
+        baseline: dict[str, float],
+        soft_timed_out: dict[str, float] | None = None,
+        factor: float | None = None,
+        min_duration: float = 1.0,
+) -> list[dict]:
+    """
+    Find the nodes that ran much longer than usual.
+
+    Args:
+        execution_times: The execution times of the nodes of the run.
+        baseline: The usual execution times of the nodes.
+        soft_timed_out: The soft timeouts of the nodes that exceeded them.
+        factor: Nodes that ran longer than factor times their baseline are stragglers.
+            Defaults to DBT_STRAGGLER_FACTOR or 3.
+        min_duration: Nodes that ran shorter than this are never compared to their baseline.
+
+    Returns:
+        The stragglers with their execution time, baseline and the reason.
+    """
+    soft_timed_out = soft_timed_out or {}
+    if factor is None:
+        factor = float(os.environ.get('DBT_STRAGGLER_FACTOR', 3))
+    stragglers = []
+    for unique_id, execution_time in execution_times.items():
+        usual = baseline.get(unique_id)
+        if unique_id in soft_timed_out:
+            reason = 'soft_timeout'
+        elif usual is not None and execution_time >= min_duration and execution_time > factor * usual:
+            reason = 'baseline'
+        else:
+            continue
+        stragglers.append({
+            'unique_id': unique_id,
+            'execution_time': execution_time,
+            'baseline': usual,
+            'reason': reason,
+        })
+    return stragglers
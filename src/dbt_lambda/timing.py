@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterator
+
+logger = logging.getLogger()
+logger.setLevel('INFO')
+
+
+@dataclass
+class Span:
+    name: str
+    wall_time: float = 0
+    cpu_time: float = 0
+    peak_memory: int | None = None
+
+    @property
+    def as_dict(self):
+        return self.__dict__
+
+
+class Timings:
+    """
+    Records the wall time, CPU time and peak traced memory of named phases.
+
+    CPU time and traced memory are process-wide, so they include concurrent threads.
+    Peak memory is only recorded if tracemalloc is tracing.
+    """
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self.lock = threading.Lock()
+        # running peak memory of the open spans
+        self.open_peaks: dict[int, int] = {}
+
+    def update_open_peaks(self, peak: int):
+        for key, value in self.open_peaks.items():
+            self.open_peaks[key] = max(value, peak)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        parent = current_span_name.get()
+        span = Span(name=f'{parent}/{name}' if parent else name)
+        token = current_span_name.set(span.name)
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            with self.lock:
+                self.update_open_peaks(tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+                self.open_peaks[id(span)] = tracemalloc.get_traced_memory()[0]
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield span
+        finally:
+            span.wall_time = time.perf_counter() - start_wall
+            span.cpu_time = time.process_time() - start_cpu
+            if tracing:
+                with self.lock:
+                    self.update_open_peaks(tracemalloc.get_traced_memory()[1])
+                    span.peak_memory = self.open_peaks.pop(id(span))
+            current_span_name.reset(token)
+            with self.lock:
+                self.spans.append(span)
+
+    @property
+    def as_list(self) -> list[dict]:
+        return [span.as_dict for span in sorted(self.spans, key=lambda span: span.name)]
+
+    def emit_metrics(self, namespace: str, dimensions: dict[str, str] | None = None):
+        """
+        Print the spans as CloudWatch Embedded Metric Format lines, one line per span.
+        """
+        dimensions = dimensions or {}
+        for span in self.spans:
+            metrics = [
+                {'Name': 'WallTime', 'Unit': 'Seconds'},
+                {'Name': 'CpuTime', 'Unit': 'Seconds'},
+            ]
+            values = {'WallTime': span.wall_time, 'CpuTime': span.cpu_time}
+            if span.peak_memory is not None:
+                metrics.append({'Name': 'PeakMemory', 'Unit': 'Bytes'})
+                values['PeakMemory'] = span.peak_memory
+            print(json.dumps({
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [[*dimensions, 'Phase']],
+                        'Metrics': metrics,
+                    }]
+                },
+                **dimensions,
+                'Phase': span.name,
+                **values,
+            }), flush=True)
+
+
+current_timings: ContextVar[Timings | None] = ContextVar('current_timings', default=None)
+current_span_name: ContextVar[str] = ContextVar('current_span_name', default='')
+
+
+@contextmanager
+def record(trace_memory: bool = False) -> Iterator[Timings]:
+    """
+    Record the spans of the current context.
+
+    Args:
+        trace_memory: Trace memory allocations with tracemalloc to record the peak memory of each span.
+    """
+    timings = Timings()
+    token = current_timings.set(timings)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        yield timings
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        current_timings.reset(token)
+
+
+@contextmanager
+def span(name: str) -> Iterator[Span | None]:
+    """
+    Record a span on the current timings. Does nothing if no timings are recorded.
+    """
+    timings = current_timings.get()
+    if timings is None:
+        yield None
+        return
+    with timings.span(name) as s:
+        yield s
+
+
+def max_rss() -> int:
+    """
+    Maximum resident set size of the process in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def emit_metrics(timings: Timings):
+    namespace = os.environ.get('DBT_METRICS_NAMESPACE')
+    if namespace:
+        dimensions = {'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')}
+        timings.emit_metrics(namespace, dimensions)
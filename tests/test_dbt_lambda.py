@@ -1,6 +1,13 @@
+import json
 import logging
 import os
+import shutil
 import subprocess
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
@@ -9,12 +16,21 @@ import dbt_lambda.app as app
 import dbt_lambda.main as main
 import dbt_lambda.docs as docs
 import pytest
+from botocore.exceptions import ClientError
 
+from benchmarks.emulator import summarize
+from benchmarks.generator import generate_project
+from dbt_lambda.archive import MultipartWriter
+from dbt_lambda.archive import download_file
+from dbt_lambda import cache
 from dbt_lambda import git
+from dbt_lambda import history
 from dbt_lambda.app import notify_hook
 from dbt_lambda.config import get_parameters
 from dbt_lambda.config import set_env_vars
 from dbt_lambda.main import run_single_threaded
+from dbt_lambda.profiling import compact_adapter_response
+from dbt_lambda.profiling import top_nodes
 from moto import mock_aws
 
 logger = logging.getLogger()
@@ -71,6 +87,13 @@ def base_path():
     return Path(__file__).parent / 'dbt-project'
 
 
+@pytest.fixture
+def tmp_project(base_path, tmp_path):
+    project_path = tmp_path / 'dbt-project'
+    shutil.copytree(base_path, project_path, ignore=shutil.ignore_patterns('target'))
+    return project_path
+
+
 @pytest.fixture
 def snowflake_credentials(monkeypatch):
     monkeypatch.setattr(main, 'set_snowflake_credentials_to_env', lambda: None)
@@ -94,7 +117,8 @@ def dbt_result():
                     },
                     'unique_id': 'model.test.test_model'
                 },
-                'status': 'success'
+                'status': 'success',
+                'adapter_response': {}
             },
             {
                 'execution_time': 0,
@@ -110,7 +134,8 @@ def dbt_result():
                     },
                     'unique_id': 'test.test.failing_test'
                 },
-                'status': 'fail'
+                'status': 'fail',
+                'adapter_response': {}
             },
             {
                 'execution_time': 0,
@@ -126,7 +151,8 @@ def dbt_result():
                     },
                     'unique_id': 'test.test.warning_test'
                 },
-                'status': 'warn'
+                'status': 'warn',
+                'adapter_response': {}
             },
         ],
         'success': False
@@ -149,6 +175,14 @@ def test_successful_app_run(dbt_result, base_path, snowflake_credentials, env_va
     res = app.lambda_handler(event, None)
 
     # remove execution times
+    timings = res.pop('timings')
+    assert [timing['name'] for timing in timings] == [
+        'config', 'run', 'run/copy', 'run/execute', 'run/parse', 'run/secrets'
+    ]
+    assert res.pop('max_rss') > 0
+    assert len(res.pop('run_id')) == 36
+    execution_times = [node['execution_time'] for node in res.pop('top_nodes')['slowest']]
+    assert execution_times == sorted((node['execution_time'] for node in res['nodes']), reverse=True)
     for node in res['nodes']:
         node['execution_time'] = 0
     res['message'] = '\n'.join(m[:-2] for m in res['message'].split('\n'))
@@ -186,19 +220,19 @@ test.test.warning_test......................................warn[1] in 0"""
         'node_info': {
             'node_path': 'testrun/test_model.sql', 'node_name': 'test_model', 'unique_id': 'model.test.test_model',
             'materialized': 'view', 'node_relation': {'database': 'memory', 'schema': 'main', 'alias': 'test_model'}
-        }, 'status': 'success', 'execution_time': 0, 'failures': None
+        }, 'status': 'success', 'execution_time': 0, 'failures': None, 'adapter_response': {}
     }, {
         'node_info': {
             'node_path': 'failing_test.sql', 'node_name': 'failing_test', 'unique_id': 'test.test.failing_test',
             'materialized': 'test',
             'node_relation': {'database': 'memory', 'schema': 'main_dbt_test__audit', 'alias': 'failing_test'}
-        }, 'status': 'fail', 'execution_time': 0, 'failures': 1
+        }, 'status': 'fail', 'execution_time': 0, 'failures': 1, 'adapter_response': {}
     }, {
         'node_info': {
             'node_path': 'warning_test.sql', 'node_name': 'warning_test', 'unique_id': 'test.test.warning_test',
             'materialized': 'test',
             'node_relation': {'database': 'memory', 'schema': 'main_dbt_test__audit', 'alias': 'warning_test'}
-        }, 'status': 'warn', 'execution_time': 0, 'failures': 1
+        }, 'status': 'warn', 'execution_time': 0, 'failures': 1, 'adapter_response': {}
     }]
 
 
@@ -292,3 +326,728 @@ def test_copy_to_s3(base_path, parameters, dbt_docs_bucket, monkeypatch):
 
     files_in_base_path = sorted(f.relative_to(base_path) for f in base_path.glob('**/*') if f.is_file())
     assert files_in_base_path == files_in_tmp_path
+
+
+@pytest.mark.parametrize('shape', ['wide', 'deep', 'diamond'])
+def test_generated_project(shape, snowflake_credentials):
+    with TemporaryDirectory() as tmp_dir:
+        base_path = generate_project(Path(tmp_dir) / 'dbt-project', n_models=4, shape=shape)
+        res = run_single_threaded(args=['build'], source='local', base_path=base_path)
+    assert res.success
+    assert len(res.nodes) == 8
+
+
+def test_emulator_summary():
+    records = [
+        {'init_duration': 3.0, 'duration': 5.0, 'error': None, 'cached': False, 'queue_wait': 0.0, 'latency': 8.0,
+         'cold': True},
+        {'init_duration': None, 'duration': 1.0, 'error': None, 'cached': True, 'queue_wait': 2.0, 'latency': 3.0,
+         'cold': False},
+        {'init_duration': None, 'duration': 2.0, 'error': 'failed', 'cached': False, 'queue_wait': 0.0, 'latency': 2.0,
+         'cold': False},
+    ]
+    summary = summarize(records, wall_time=10.0, containers_started=1)
+    assert summary['requests'] == 3
+    assert summary['errors'] == 1
+    assert summary['cached'] == 1
+    assert summary['cold_start_share'] == 1 / 3
+    assert summary['throughput'] == 0.3
+    assert summary['latency']['p50'] == 3.0
+    assert summary['latency']['max'] == 8.0
+    assert summary['init_duration']['p99'] == 3.0
+    assert summary['warm_duration']['max'] == 2.0
+
+
+def test_slim_run(tmp_project, dbt_docs_bucket, snowflake_credentials):
+    res = run_single_threaded(args=['build'], source='local', base_path=tmp_project, state='slim')
+    assert len(res.nodes) == 3
+    assert res.skipped == []
+
+    # the manifest of a restricted selection is not published
+    res = run_single_threaded(
+        args=['run', '--select', 'test_model'], source='local', base_path=tmp_project, state='publish'
+    )
+    assert res.success
+    keys = [obj.key for obj in boto3.resource('s3').Bucket(dbt_docs_bucket).objects.all()]
+    assert 'state/manifest.json' not in keys
+
+    # the failing test was never deployed and runs again
+    res = run_single_threaded(args=['build'], source='local', base_path=tmp_project, state='slim')
+    assert 'test.test.failing_test' in [node.node_info['unique_id'] for node in res.nodes]
+    assert not res.success
+
+    (tmp_project / 'tests' / 'failing_test.sql').unlink()
+    res = run_single_threaded(args=['build'], source='local', base_path=tmp_project, state='publish')
+    assert res.success
+
+    res = run_single_threaded(args=['build'], source='local', base_path=tmp_project, state='slim')
+    assert res.nodes == []
+    assert sorted(res.skipped) == ['model.test.test_model', 'test.test.warning_test']
+
+    (tmp_project / 'models' / 'testrun' / 'test_model.sql').write_text('SELECT 2 AS int_column')
+    res = run_single_threaded(
+        args=['build', '--select', 'test_model'], source='local', base_path=tmp_project, state='slim'
+    )
+    assert [node.node_info['unique_id'] for node in res.nodes] == ['model.test.test_model']
+    assert res.skipped == []
+
+
+def test_fresher_run(tmp_project, tmp_path, dbt_docs_bucket, snowflake_credentials):
+    import duckdb
+
+    database = tmp_path / 'test.duckdb'
+    (tmp_project / 'profiles' / 'profiles.yml').write_text(
+        f'test:\n  outputs:\n    dev:\n      type: duckdb\n      path: {database}\n  target: dev\n'
+    )
+    (tmp_project / 'models' / 'testrun' / 'sources.yml').write_text(
+        'version: 2\n'
+        'sources:\n'
+        '  - name: raw\n'
+        '    schema: main\n'
+        '    loaded_at_field: loaded_at\n'
+        '    freshness:\n'
+        '      warn_after: {count: 1, period: day}\n'
+        '    tables:\n'
+        '      - name: events\n'
+    )
+    (tmp_project / 'models' / 'testrun' / 'events_model.sql').write_text(
+        "SELECT * FROM {{ source('raw', 'events') }}"
+    )
+    with duckdb.connect(str(database)) as con:
+        con.execute("CREATE TABLE events AS SELECT 1 AS id, TIMESTAMP '2024-01-01 00:00:00' AS loaded_at")
+
+    (tmp_project / 'tests' / 'failing_test.sql').unlink()
+    args = ['build']
+    res = run_single_threaded(args=args, source='local', base_path=tmp_project, state='fresher')
+    assert len(res.nodes) == 3
+    assert res.skipped == []
+
+    res = run_single_threaded(args=args, source='local', base_path=tmp_project, state='fresher')
+    assert res.nodes == []
+    assert sorted(res.skipped) == ['model.test.events_model', 'model.test.test_model', 'test.test.warning_test']
+
+    with duckdb.connect(str(database)) as con:
+        con.execute("INSERT INTO events VALUES (2, TIMESTAMP '2024-01-02 00:00:00')")
+    res = run_single_threaded(args=args, source='local', base_path=tmp_project, state='fresher')
+    assert [node.node_info['unique_id'] for node in res.nodes] == ['model.test.events_model']
+    assert len(res.skipped) == 2
+
+    bucket = boto3.resource('s3').Bucket(dbt_docs_bucket)
+    keys = sorted(obj.key for obj in bucket.objects.filter(Prefix='state/'))
+    # the selection is restricted to fresher sources, so the manifest is not published
+    assert keys == ['state/sources-previous.json', 'state/sources.json']
+
+
+def test_keep_connections(base_path, snowflake_credentials, monkeypatch):
+    from dbt_lambda.connections import connection_pool
+
+    monkeypatch.setenv('DBT_KEEP_CONNECTIONS', 'True')
+    run_single_threaded(args=['run'], source='local', base_path=base_path)
+    size = connection_pool.size()
+    assert size > 0
+
+    stats = connection_pool.stats.copy()
+    monkeypatch.setattr(connection_pool, 'health_check_after', 0)
+    run_single_threaded(args=['run'], source='local', base_path=base_path)
+    assert connection_pool.stats['reused'] > stats['reused']
+
+    # the pool takes the idle timeout of the environment, restore it after the test
+    monkeypatch.setattr(connection_pool, 'idle_timeout', connection_pool.idle_timeout)
+    monkeypatch.setenv('DBT_CONNECTION_IDLE_TIMEOUT', '0')
+    stats = connection_pool.stats.copy()
+    run_single_threaded(args=['run'], source='local', base_path=base_path)
+    assert connection_pool.stats['closed'] >= stats['closed'] + size
+
+    monkeypatch.setenv('DBT_KEEP_CONNECTIONS', 'False')
+    run_single_threaded(args=['run'], source='local', base_path=base_path)
+    assert connection_pool.size() == 0
+
+
+def test_timings(base_path, snowflake_credentials, env_vars, monkeypatch, capsys):
+    monkeypatch.setenv('DBT_TRACE_MEMORY', 'True')
+    monkeypatch.setenv('DBT_METRICS_NAMESPACE', 'dbt-lambda')
+    event = {
+        'args': ['run'],
+        'source': 'local',
+        'base_path': base_path
+    }
+    res = app.lambda_handler(event, None)
+    timings = {timing['name']: timing for timing in res['timings']}
+    assert timings['run']['wall_time'] >= timings['run/execute']['wall_time']
+    assert timings['run']['peak_memory'] >= timings['run/parse']['peak_memory'] > 0
+
+    metrics = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+    assert sorted(metric['Phase'] for metric in metrics) == sorted(timings)
+    assert metrics[0]['_aws']['CloudWatchMetrics'][0]['Namespace'] == 'dbt-lambda'
+
+
+def test_run_steps():
+    from dbt_lambda.pipeline import run_steps
+    from dbt_lambda.pipeline import Step
+
+    def fail(message: str, delay: float = 0):
+        time.sleep(delay)
+        raise ValueError(message)
+
+    # the independent steps only finish if they run at the same time
+    barrier = threading.Barrier(2, timeout=10)
+    finished = []
+
+    def step(name: str, wait: bool = False) -> str:
+        if wait:
+            barrier.wait()
+        finished.append(name)
+        return name
+
+    result = run_steps([
+        Step('token', lambda: step('token', wait=True)),
+        Step('copy', lambda: step('copy'), depends_on=('token',)),
+        Step('secrets', lambda: step('secrets', wait=True)),
+    ])
+    assert result == {'token': 'token', 'copy': 'copy', 'secrets': 'secrets'}
+    assert finished.index('copy') > finished.index('token')
+
+    called = []
+    with pytest.raises(ValueError) as e:
+        run_steps([
+            Step('token', lambda: fail('token', delay=0.1)),
+            Step('copy', lambda: called.append('copy'), depends_on=('token',)),
+            Step('secrets', lambda: fail('secrets')),
+        ])
+    assert e.value.__str__() == 'token'
+    assert called == []
+
+
+@pytest.mark.parametrize('compression', ['stored', 'deflated', 'bzip2'])
+def test_copy_to_s3_multipart(tmp_project, tmp_path, dbt_docs_bucket, compression):
+    (tmp_project / 'seeds').mkdir()
+    (tmp_project / 'seeds' / 'large.csv').write_bytes(os.urandom(6 * 1024 * 1024))
+    git.copy_to_s3(tmp_project, compression=compression, compression_level=1, part_size=5 * 1024 * 1024)
+
+    target_path = tmp_path / 'target' / 'dbt-project'
+    target_path.mkdir(parents=True)
+    git.copy_from_s3(target_path)
+    for file in tmp_project.glob('**/*'):
+        if file.is_file():
+            assert (target_path / file.relative_to(tmp_project)).read_bytes() == file.read_bytes()
+
+
+def test_multipart_abort(dbt_docs_bucket, monkeypatch):
+    client = boto3.client('s3')
+
+    def fail(**kwargs):
+        raise ClientError({'Error': {'Code': 'InvalidPart', 'Message': 'part'}}, 'CompleteMultipartUpload')
+
+    monkeypatch.setattr(client, 'complete_multipart_upload', fail)
+    writer = MultipartWriter(client, dbt_docs_bucket, 'large.zip', part_size=5 * 1024 * 1024)
+    with pytest.raises(ClientError):
+        with writer:
+            writer.write(os.urandom(6 * 1024 * 1024))
+    assert 'Uploads' not in client.list_multipart_uploads(Bucket=dbt_docs_bucket)
+    assert 'Contents' not in client.list_objects_v2(Bucket=dbt_docs_bucket)
+
+
+def test_copy_from_s3_incremental(tmp_project, tmp_path, dbt_docs_bucket):
+    git.copy_to_s3(tmp_project)
+
+    target_path = tmp_path / 'target' / 'dbt-project'
+    result = git.copy_from_s3(target_path)
+    assert result == {'written': 5, 'unchanged': 0, 'removed': 0}
+    assert git.copy_from_s3(target_path) == {'written': 0, 'unchanged': 5, 'removed': 0}
+
+    (tmp_project / 'tests' / 'failing_test.sql').unlink()
+    (tmp_project / 'models' / 'testrun' / 'test_model.sql').write_text('SELECT 2 AS int_column')
+    git.copy_to_s3(tmp_project)
+    result = git.copy_from_s3(target_path)
+    assert result == {'written': 1, 'unchanged': 3, 'removed': 1}
+    assert not (target_path / 'tests' / 'failing_test.sql').exists()
+    assert (target_path / 'models' / 'testrun' / 'test_model.sql').read_text() == 'SELECT 2 AS int_column'
+
+    client = boto3.client('s3')
+    head = client.head_object(Bucket=dbt_docs_bucket, Key='dbt-project.zip')
+    zip_path = tmp_path / 'dbt-project.zip'
+    download_file(client, dbt_docs_bucket, 'dbt-project.zip', zip_path, head['ContentLength'], part_size=100)
+    body = client.get_object(Bucket=dbt_docs_bucket, Key='dbt-project.zip')['Body'].read()
+    assert zip_path.read_bytes() == body
+
+
+def test_install_packages(tmp_project, tmp_path, dbt_docs_bucket, snowflake_credentials):
+    package_path = tmp_path / 'package'
+    (package_path / 'macros').mkdir(parents=True)
+    (package_path / 'dbt_project.yml').write_text('name: package\nversion: 1.0.0\nconfig-version: 2\n')
+    (package_path / 'macros' / 'one.sql').write_text('{% macro one() %}1{% endmacro %}')
+    (tmp_project / 'packages.yml').write_text(f'packages:\n  - local: {package_path}\n')
+    (tmp_project / 'models' / 'testrun' / 'package_model.sql').write_text('SELECT {{ package.one() }} AS one')
+
+    res = git.install_packages(tmp_project)
+    assert res['message'].startswith('Installed packages with dbt deps')
+    assert not (tmp_project / 'package-lock.yml').exists()
+    assert git.install_packages(tmp_project)['message'].startswith('Packages are unchanged')
+
+    shutil.rmtree(tmp_project / 'dbt_packages')
+    res = git.install_packages(tmp_project)
+    assert res['message'].startswith('Restored packages from packages/')
+    assert (tmp_project / 'dbt_packages' / 'package' / 'macros' / 'one.sql').is_file()
+
+    res = run_single_threaded(args=['run', '--select', 'package_model'], source='local', base_path=tmp_project)
+    assert res.success
+    assert 'packages' in [step.name for step in main.setup_steps('s3', tmp_project)]
+    assert 'packages' not in [step.name for step in main.setup_steps('local', tmp_project)]
+
+
+def test_top_nodes():
+    nodes = [
+        main.NodeResult(
+            node_info={'unique_id': f'model.test.model_{i}'},
+            status='success',
+            execution_time=execution_time,
+            failures=None,
+            adapter_response=compact_adapter_response(adapter_response),
+        )
+        for i, (execution_time, adapter_response) in enumerate([
+            (3.0, {'_message': 'SUCCESS 1', 'code': 'SUCCESS', 'rows_affected': 10, 'query_id': 'a'}),
+            (1.0, {'_message': 'SUCCESS 1', 'code': 'SUCCESS', 'rows_affected': 1000, 'query_id': 'b'}),
+            (2.0, {'_message': 'OK'}),
+        ])
+    ]
+    assert nodes[2].adapter_response == {}
+    summary = top_nodes(nodes, n=2)
+    assert [node['unique_id'] for node in summary['slowest']] == ['model.test.model_0', 'model.test.model_2']
+    assert summary['heaviest'] == [
+        {'unique_id': 'model.test.model_1', 'execution_time': 1.0, 'code': 'SUCCESS', 'rows_affected': 1000,
+         'query_id': 'b'},
+        {'unique_id': 'model.test.model_0', 'execution_time': 3.0, 'code': 'SUCCESS', 'rows_affected': 10,
+         'query_id': 'a'},
+    ]
+
+
+def test_query_tags(tmp_project, dbt_docs_bucket, snowflake_credentials):
+    models_path = tmp_project / 'models' / 'testrun'
+    (models_path / 'tag_model.sql').write_text("SELECT '{{ config.get(\"query_tag\") }}' AS query_tag")
+    project = main.prepare_project('local', tmp_project)
+    res = main.invoke_command(project, ['run'], state='publish')
+    compiled = (tmp_project / 'target' / 'compiled' / 'test' / 'models' / 'testrun' / 'tag_model.sql').read_text()
+    assert json.loads(compiled.split("'")[1]) == {'run_id': res.run_id, 'unique_id': 'model.test.tag_model'}
+    # the manifest is published as state without the tags of the run
+    body = boto3.resource('s3').Object(dbt_docs_bucket, 'state/manifest.json').get()['Body'].read()
+    assert json.loads(body)['nodes']['model.test.test_model']['config'].get('query_tag') is None
+    # the parsed manifest is reused by the next invocation without the tags
+    parsed = next(iter(project.manifests.values()))
+    assert parsed.nodes['model.test.test_model'].config.get('query_tag') is None
+
+
+def test_run_history(base_path, dbt_docs_bucket, snowflake_credentials, monkeypatch):
+    today = datetime.now(timezone.utc)
+    for i in range(6):
+        nodes = [
+            main.NodeResult(
+                node_info={'unique_id': 'model.test.slow_model'}, status='success', execution_time=2.0 + i % 2,
+                failures=None
+            ),
+            main.NodeResult(
+                node_info={'unique_id': 'model.test.failed_model'}, status='error', execution_time=0.1, failures=None
+            ),
+        ]
+        history.write_run(f'run-{i}', ['run'], nodes, timestamp=today - timedelta(days=i % 3))
+    # compile doesn't materialize the nodes and is not part of the baseline
+    compiled = [main.NodeResult(
+        node_info={'unique_id': 'model.test.slow_model'}, status='success', execution_time=0.01, failures=None
+    )]
+    history.write_run('compile-0', ['compile'], compiled, timestamp=today)
+    # the run files of a day are deleted in batches of at most delete_batch_size keys
+    bucket = boto3.resource('s3').Bucket(dbt_docs_bucket)
+    deletes = []
+    bucket.meta.client.meta.events.register(
+        'provide-client-params.s3.DeleteObjects', lambda params, **kwargs: deletes.append(len(params['Delete']['Objects']))
+    )
+    monkeypatch.setattr(history, 'get_dbt_docs_bucket', lambda: bucket)
+    monkeypatch.setattr(history, 'delete_batch_size', 1)
+    res = history.compact_history(today=today.date())
+    assert res['compacted'] == 4
+    assert deletes == [1, 1, 1, 1]
+    keys = sorted(obj.key for obj in boto3.resource('s3').Bucket(dbt_docs_bucket).objects.filter(Prefix='history/'))
+    assert keys == [
+        'history/baseline.json',
+        f'history/date={(today - timedelta(days=2)).date()}/compacted.jsonl',
+        f'history/date={(today - timedelta(days=1)).date()}/compacted.jsonl',
+        f'history/date={today.date()}/compile-0.jsonl',
+        f'history/date={today.date()}/run-0.jsonl',
+        f'history/date={today.date()}/run-3.jsonl',
+    ]
+
+    baseline = history.load_history()
+    assert baseline == {'model.test.slow_model': {'median': 2.5, 'runs': 6}}
+    regressions = history.find_regressions({'model.test.slow_model': 4.0, 'model.test.new_model': 9.0}, baseline)
+    assert regressions == [{
+        'unique_id': 'model.test.slow_model', 'execution_time': 4.0, 'median': 2.5, 'runs': 6, 'ratio': 1.6
+    }]
+
+    monkeypatch.setenv('DBT_RUN_HISTORY', 'True')
+    res = run_single_threaded(args=['run'], source='local', base_path=base_path)
+    records = boto3.resource('s3').Object(
+        dbt_docs_bucket, f'history/date={datetime.now(timezone.utc).date()}/{res.run_id}.jsonl'
+    ).get()['Body'].read().decode('utf-8').splitlines()
+    assert [json.loads(record)['unique_id'] for record in records] == ['model.test.test_model']
+
+
+def test_evict_projects(monkeypatch):
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        monkeypatch.setenv('DBT_CACHE_ROOT', tmp_dir)
+        for i, (repository_name, ref) in enumerate([('analytics', 'main'), ('finance', 'main'), ('finance', 'dev')]):
+            entry = cache.project_path(repository_name, ref).parent
+            entry.mkdir(parents=True)
+            os.utime(entry, (i, i))
+        assert cache.evict_projects(min_free_bytes=0) == []
+        keep = cache.project_path('analytics', 'main').parent
+        free = shutil.disk_usage(root).free
+        evicted = cache.evict_projects(keep=keep, min_free_bytes=free * 2)
+        assert evicted == ['finance-main', 'finance-dev']
+        assert [entry.name for entry in root.iterdir()] == ['analytics-main']
+
+
+def test_repository_project(tmp_project, tmp_path, dbt_docs_bucket, snowflake_credentials):
+    key = git.project_archive_key('analytics', 'main')
+    assert key == 'projects/analytics/main/dbt-project.zip'
+    git.copy_to_s3(tmp_project, key=key)
+
+    project_path = cache.use_project('analytics', 'main', root=tmp_path / 'cache')
+    res = run_single_threaded(
+        args=['run'], source='s3', base_path=project_path, state='publish', repository_name='analytics', ref='main'
+    )
+    assert res.success
+    assert (project_path / 'dbt_project.yml').exists()
+    keys = [obj.key for obj in boto3.resource('s3').Bucket(dbt_docs_bucket).objects.all()]
+    assert 'state/analytics/main/manifest.json' in keys
+    assert 'state/manifest.json' not in keys
+
+
+def test_commands_app_run(base_path, snowflake_credentials, env_vars, monkeypatch):
+    parse_calls = []
+    parse_project = main.parse_project
+
+    def counting_parse_project(project, args):
+        parse_calls.append(len(project.manifests))
+        return parse_project(project, args)
+
+    monkeypatch.setattr(main, 'parse_project', counting_parse_project)
+    event = {
+        'commands': [
+            {'args': ['run']},
+            {'args': ['test'], 'continue_on_error': True},
+            {'args': ['ls']},
+            {'args': ['run']},
+        ],
+        'source': 'local',
+        'base_path': base_path
+    }
+    res = app.lambda_handler(event, None)
+    assert parse_calls == [0, 1, 1, 1]
+    assert [step['args'] for step in res['steps']] == [['run'], ['test'], ['ls'], ['run']]
+    assert [step['success'] for step in res['steps']] == [True, False, True, True]
+    assert len(res['nodes']) == 1 + 2 + 1
+    assert res['steps'][2]['output']
+    assert 'top_nodes' in res['steps'][0]
+    assert res['success'] is False
+    assert res['error'] == 'DbtRuntimeError'
+    names = [timing['name'] for timing in res['timings']]
+    assert names.count('run/step-0/parse') == 1
+    assert 'run/step-1/parse' not in names
+    assert 'run/copy' in names
+    assert 'test.test.failing_test' in notify_hook(res)
+
+    event['commands'] = [{'args': ['test']}, {'args': ['run']}]
+    res = app.lambda_handler(event, None)
+    assert [step['args'] for step in res['steps']] == [['test']]
+    assert res['success'] is False
+
+    def failing_download_state(*args, **kwargs):
+        raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'GetObject')
+
+    monkeypatch.setattr(main, 'download_state', failing_download_state)
+    event['commands'] = [{'args': ['run']}, {'args': ['run'], 'state': 'slim'}]
+    res = app.lambda_handler(event, None)
+    assert [step['success'] for step in res['steps']] == [True, False]
+    assert len(res['nodes']) == 1
+    assert 'AccessDenied' in res['steps'][1]['error']
+
+
+def test_group_requests():
+    from dbt_lambda.coalesce import group_requests, Request
+    requests = [
+        Request('1', {'args': ['run', '--select', 'a'], 'source': 's3'}),
+        Request('2', {'args': ['run', '-s', 'b', 'a'], 'source': 's3'}),
+        Request('3', {'args': ['run', '--select', 'a'], 'source': 'repo'}),
+        Request('4', {'args': ['test', '--target', 'prod', '--select', 'a']}),
+        Request('5', {'args': ['test', '--target', 'prod']}),
+    ]
+    groups = group_requests(requests)
+    assert [group.coalesced_args for group in groups] == [
+        ['run', '--select', 'a', 'b'],
+        ['run', '--select', 'a'],
+        ['test', '--target', 'prod'],
+    ]
+    assert [[request.message_id for request in group.requests] for group in groups] == [['1', '2'], ['3'], ['4', '5']]
+
+
+def test_sqs_handler(base_path, snowflake_credentials, env_vars, monkeypatch, mocked_aws):
+    invocations = []
+    invoke_command = main.invoke_command
+
+    def counting_invoke_command(project, args, state=None):
+        invocations.append(args)
+        return invoke_command(project, args, state)
+
+    monkeypatch.setattr(app, 'invoke_command', counting_invoke_command)
+    client = boto3.client('sqs')
+    queue_url = client.create_queue(QueueName='dbt-requests')['QueueUrl']
+    for body in [
+        {'args': ['test', '--select', 'failing_test'], 'source': 'local', 'base_path': str(base_path)},
+        {'args': ['test', '--select', 'warning_test'], 'source': 'local', 'base_path': str(base_path)},
+        {'args': ['test', '--select', 'warning_test'], 'source': 'local', 'base_path': str(base_path)},
+        {'args': ['x-error']},
+        {'args': ['ls', '--select', 'warning_test'], 'source': 'local', 'base_path': str(base_path)},
+    ]:
+        client.send_message(QueueUrl=queue_url, MessageBody=json.dumps(body))
+    client.send_message(QueueUrl=queue_url, MessageBody='not json')
+    messages = client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)['Messages']
+    event = {'Records': [
+        {'messageId': message['MessageId'], 'body': message['Body'], 'eventSource': 'aws:sqs'}
+        for message in messages
+    ]}
+    message_ids = [message['MessageId'] for message in messages]
+
+    res = app.sqs_handler(event, None)
+    assert invocations == [['test', '--select', 'failing_test', 'warning_test']]
+    assert res['batchItemFailures'] == [
+        {'itemIdentifier': message_ids[5]},
+        {'itemIdentifier': message_ids[3]},
+        {'itemIdentifier': message_ids[0]},
+    ]
+    responses = res['responses']
+    assert [node['node_info']['unique_id'] for node in responses[message_ids[0]]['nodes']] == [
+        'test.test.failing_test'
+    ]
+    for message_id in message_ids[1:3]:
+        assert responses[message_id]['success'] is True
+        assert [node['status'] for node in responses[message_id]['nodes']] == ['warn']
+    # only execution commands are coalesced, ls keeps its output
+    assert responses[message_ids[4]]['output'] == ['test.warning_test']
+
+
+def test_run_group_missing_results(monkeypatch):
+    from dbt_lambda.coalesce import group_requests, Request
+    from dbt_lambda.main import NodeResult, RunnerResult
+
+    # the failed command only reached model a, e.g. a compilation error stopped it before model b
+    node_info = {
+        'unique_id': 'model.test.a', 'materialized': 'view',
+        'node_relation': {'database': 'memory', 'schema': 'main', 'alias': 'a'},
+    }
+    node = NodeResult(node_info=node_info, status='success', execution_time=0, failures=None)
+    monkeypatch.setattr(app, 'prepare_project', lambda *args: None)
+    monkeypatch.setattr(app, 'invoke_command', lambda *args: RunnerResult(success=False, nodes=[node]))
+    monkeypatch.setattr(app, 'select_nodes', lambda project, args: [f'model.test.{name}' for name in args[2:]])
+    group, = group_requests([
+        Request('1', {'args': ['run', '--select', 'a'], 'source': 'local'}),
+        Request('2', {'args': ['run', '--select', 'b'], 'source': 'local'}),
+    ])
+    responses = app.run_group(group)
+    assert responses['1']['success'] is True
+    assert responses['2']['success'] is False
+    assert responses['2']['nodes'] == []
+
+
+def test_node_timeouts(tmp_project, snowflake_credentials, monkeypatch):
+    models_path = tmp_project / 'models' / 'testrun'
+    (models_path / 'slow_model.sql').write_text(
+        "{{ config(materialized='table', meta={'soft_timeout': 0.5, 'hard_timeout': 1}) }}\n"
+        "SELECT count(*) AS n FROM range(100000000) a, range(100000) b WHERE a.range + b.range < 0"
+    )
+    (models_path / 'after_slow_model.sql').write_text("SELECT * FROM {{ ref('slow_model') }}")
+    start = time.perf_counter()
+    res = run_single_threaded(args=['run'], source='local', base_path=tmp_project)
+    assert time.perf_counter() - start < 30
+    statuses = {node.node_info['unique_id']: node.status for node in res.nodes}
+    assert statuses == {
+        'model.test.slow_model': 'timeout',
+        'model.test.after_slow_model': 'skipped',
+        'model.test.test_model': 'success',
+    }
+    assert not res.success
+    assert [(s['unique_id'], s['reason']) for s in res.stragglers] == [('model.test.slow_model', 'soft_timeout')]
+    assert 'slow_model' in res.failed().as_str
+
+    # a node that doesn't return after the cancellation is abandoned and the run completes
+    from dbt_lambda.timeouts import Watchdog
+    cancel = Watchdog.cancel
+    delayed_cancels = []
+
+    def delayed_cancel(entry):
+        delayed_cancels.append(threading.Timer(10, cancel, [entry]))
+        delayed_cancels[-1].start()
+
+    monkeypatch.setattr(Watchdog, 'cancel', staticmethod(delayed_cancel))
+    monkeypatch.setenv('DBT_NODE_CANCEL_GRACE_PERIOD', '0.5')
+    res = run_single_threaded(args=['run'], source='local', base_path=tmp_project)
+    assert delayed_cancels[0].is_alive()
+    statuses = {node.node_info['unique_id']: node.status for node in res.nodes}
+    assert statuses['model.test.slow_model'] == 'timeout'
+    assert statuses['model.test.after_slow_model'] == 'skipped'
+    delayed_cancels[0].join()
+
+
+def test_watchdog_cancel_connection():
+    from contextlib import contextmanager
+    from types import SimpleNamespace
+    from dbt.adapters.exceptions import InvalidConnectionError
+    from dbt_lambda.timeouts import NodeTimeouts, RunningNode, Watchdog
+
+    class ConnectionManager:
+        """
+        Cancels like dbt-snowflake with a query on the connection of the calling thread.
+        """
+
+        def __init__(self):
+            self.thread_connections = {}
+            self.queries = []
+
+        def get_thread_connection(self):
+            key = (os.getpid(), threading.get_ident())
+            if key not in self.thread_connections:
+                raise InvalidConnectionError(threading.get_ident(), list(self.thread_connections))
+            return self.thread_connections[key]
+
+        def add_query(self, sql):
+            self.queries.append((self.get_thread_connection().name, sql))
+
+        def cancel(self, connection):
+            self.add_query(f'select system$cancel_all_queries({connection.handle})')
+
+    class Adapter:
+        connections = ConnectionManager()
+
+        @contextmanager
+        def connection_named(self, name):
+            key = (os.getpid(), threading.get_ident())
+            self.connections.thread_connections[key] = SimpleNamespace(name=name, handle=None)
+            try:
+                yield
+            finally:
+                self.connections.thread_connections.pop(key)
+
+    adapter = Adapter()
+    worker_id = threading.get_ident() + 1
+    adapter.connections.thread_connections[(os.getpid(), worker_id)] = SimpleNamespace(name='slow_model', handle=42)
+    entry = RunningNode(
+        unique_id='model.test.slow_model',
+        pool=None,
+        runner=SimpleNamespace(adapter=adapter),
+        callback=lambda result: None,
+        timeouts=NodeTimeouts(hard=1),
+        started_at=time.monotonic() - 2,
+        thread_id=worker_id,
+    )
+    watchdog = Watchdog()
+    watchdog.check(entry)
+    assert watchdog.timed_out == {'model.test.slow_model': 1}
+    assert adapter.connections.queries == [('watchdog', 'select system$cancel_all_queries(42)')]
+
+
+def test_baseline(tmp_path, monkeypatch):
+    from dbt_lambda.timeouts import load_baseline, save_baseline
+    monkeypatch.setenv('DBT_BASELINES_ROOT', str(tmp_path / 'baselines'))
+    project_path = tmp_path / 'dbt-project'
+    assert load_baseline(project_path, 'run') == {}
+    save_baseline(project_path, 'run', {'model.a': 2.0, 'model.b': 1.0})
+    save_baseline(project_path, 'run', {'model.a': 3.0})
+    save_baseline(project_path, 'compile', {'model.a': 0.1})
+    assert load_baseline(project_path, 'run') == {'model.a': 3.0, 'model.b': 1.0}
+    assert load_baseline(project_path, 'compile') == {'model.a': 0.1}
+    # the baseline is kept when the project is copied again
+    assert not project_path.exists()
+    assert load_baseline(tmp_path / 'other-project', 'run') == {}
+
+
+def test_find_stragglers():
+    from dbt_lambda.timeouts import find_stragglers
+    stragglers = find_stragglers(
+        {'model.a': 10.0, 'model.b': 2.0, 'model.c': 0.5, 'model.d': 5.0},
+        {'model.a': 2.0, 'model.b': 1.5, 'model.c': 0.1},
+        factor=3,
+    )
+    assert stragglers == [{'unique_id': 'model.a', 'execution_time': 10.0, 'baseline': 2.0, 'reason': 'baseline'}]
+
+
+def test_cached_commands(tmp_project, tmp_path, snowflake_credentials, env_vars, mocked_aws, monkeypatch):
+    from dbt_lambda import artifacts
+    boto3.client('s3').create_bucket(
+        Bucket='sandbox-dbt-docs-dev', CreateBucketConfiguration={'LocationConstraint': 'eu-central-1'}
+    )
+    monkeypatch.setenv('DBT_ARTIFACTS_ROOT', str(tmp_path / 'artifacts'))
+    monkeypatch.setattr(artifacts, 'loaded_manifests', {})
+    ls_event = {
+        'args': ['ls', '--select', 'test_model+', '--resource-type', 'model', '--resource-type', 'test'],
+        'source': 'local',
+        'base_path': str(tmp_project),
+        'sha': 'abc123',
+    }
+    res = app.lambda_handler(ls_event, None)
+    assert 'cached' not in res
+    assert res['output'] == ['test.testrun.test_model']
+    compile_event = {**ls_event, 'args': ['compile', '--select', 'test_model']}
+    res = app.lambda_handler(compile_event, None)
+    assert 'cached' not in res
+    compiled = res['compiled']
+    assert list(compiled) == ['model.test.test_model']
+
+    # the cached commands don't need the project or the warehouse credentials
+    def fail():
+        raise AssertionError('Credentials requested')
+
+    monkeypatch.setattr(main, 'set_snowflake_credentials_to_env', fail)
+    shutil.rmtree(tmp_path / 'artifacts')
+    artifacts.loaded_manifests.clear()
+    for event in ({**ls_event, 'base_path': '/nonexistent'}, {**compile_event, 'base_path': '/nonexistent'}):
+        cached = app.lambda_handler(event, None)
+        assert cached['cached'] is True
+        assert [timing['name'] for timing in cached['timings']] == ['cache', 'config']
+    assert cached['compiled'] == compiled
+    assert [node['node_info']['unique_id'] for node in cached['nodes']] == ['model.test.test_model']
+    assert app.lambda_handler({**ls_event, 'args': ['ls', '--select', 'failing_test']}, None)['output'] == [
+        'test.failing_test'
+    ]
+    assert app.lambda_handler({**ls_event, 'args': ['parse']}, None)['cached'] is True
+    with pytest.raises(AssertionError, match='Credentials requested'):
+        app.lambda_handler({**ls_event, 'args': ['ls', '--target', 'prod']}, None)
+
+
+def test_artifacts_version_change(tmp_project, tmp_path, snowflake_credentials, env_vars, mocked_aws, monkeypatch):
+    from dbt_lambda import artifacts
+    # the handler sets the docs bucket of the configuration
+    set_env_vars()
+    bucket = boto3.resource('s3').Bucket(os.environ['DBT_DOCS_BUCKET'])
+    bucket.create(CreateBucketConfiguration={'LocationConstraint': 'eu-central-1'})
+    monkeypatch.setenv('DBT_ARTIFACTS_ROOT', str(tmp_path / 'artifacts'))
+    monkeypatch.setattr(artifacts, 'loaded_manifests', {})
+    git.copy_to_s3(tmp_project)
+    event = {'args': ['parse'], 'source': 's3', 'base_path': str(tmp_path / 'target' / 'dbt-project')}
+    previous_key = artifacts.get_artifacts_key(event)
+
+    # the project archive is replaced between the resolution of the key and the copy
+    run_single_threaded = app.run_single_threaded
+
+    def deploy_and_run(**kwargs):
+        (tmp_project / 'models' / 'testrun' / 'test_model.sql').write_text('SELECT 2 AS int_column')
+        git.copy_to_s3(tmp_project)
+        return run_single_threaded(**kwargs)
+
+    monkeypatch.setattr(app, 'run_single_threaded', deploy_and_run)
+    assert app.lambda_handler(event, None)['success'] is True
+    assert [obj.key for obj in bucket.objects.filter(Prefix='artifacts/')] == []
+
+    monkeypatch.setattr(app, 'run_single_threaded', run_single_threaded)
+    assert app.lambda_handler(event, None)['success'] is True
+    key = artifacts.get_artifacts_key(event)
+    assert key != previous_key
+    assert [obj.key for obj in bucket.objects.filter(Prefix='artifacts/')] == [f'artifacts/{key}/manifest.json']